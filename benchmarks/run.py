@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+from contextlib import contextmanager
+import psycopg2 as pg
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from synthetic import generate_projects, generate_stations, write_response
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+BENCH_SIZES = [10000, 100000, 1000000]
+BENCH_TRANSACTIONS_PER_PROJECT = 50
+BENCH_STATIONS = 150
+BENCH_RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+BENCH_FILTER_CHANGES = 50
+
+DATA_TABLES = [
+    'private_residential_property_transactions', 'private_residential_property_projects', 'transactions_rollup',
+    'dimension_catalog', 'ingestion_batches', 'ingestion_watermarks', 'geocode_cache',
+]
+
+
+def admin_params():
+    return {
+        'host': os.getenv('POSTGRES_HOST', 'localhost'),
+        'port': os.getenv('POSTGRES_PORT', '5432'),
+        'user': os.getenv('POSTGRES_USER', 'postgres'),
+        'password': os.getenv('POSTGRES_PASSWORD', 'postgres'),
+        'dbname': os.getenv('POSTGRES_DB', 'postgres'),
+    }
+
+
+@contextmanager
+def bench_database(name, keep=False):
+    """Creates a throwaway database on the configured Postgres server and points
+       the project modules at it through POSTGRES_DB, dropping it on exit
+
+    Args:
+        name (str): database name
+        keep (bool): leave the database in place, e.g. to inspect plans afterwards
+    """
+    params = admin_params()
+    admin = pg.connect(**params)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(sql.SQL('CREATE DATABASE {};').format(sql.Identifier(name)))
+        LOGGER.info(f'Created benchmark database {name}')
+        # load_dotenv never overrides variables already set, so every module imported from here on uses it
+        os.environ['POSTGRES_DB'] = name
+        yield name
+    finally:
+        os.environ['POSTGRES_DB'] = params['dbname']
+        if 'db' in sys.modules:
+            sys.modules['db'].get_pool().closeall()
+        if not keep:
+            with admin.cursor() as cur:
+                cur.execute(sql.SQL('DROP DATABASE IF EXISTS {};').format(sql.Identifier(name)))
+            LOGGER.info(f'Dropped benchmark database {name}')
+        admin.close()
+
+
+def create_schema(n_stations, seed):
+    import migrate
+    from db import cursor
+
+    migrate.create_postal_districts_table()
+    migrate.create_mrt_table()
+    migrate.create_projects_table()
+    migrate.create_transactions_table()
+    migrate.create_ingestion_state_tables()
+    migrate.create_geocode_cache_table()
+    migrate.create_data_generation_table()
+    migrate.create_dimension_catalog_table()
+    migrate.create_transactions_rollup_table()
+    migrate.create_schema_migrations_table()
+    migrate.run_migrations()
+    with cursor() as cur:
+        execute_values(
+            cur, 'INSERT INTO mrt (id, name, type, longitude, latitude) VALUES %s;', generate_stations(n_stations, seed))
+
+
+def truncate_data():
+    from db import cursor
+
+    with cursor() as cur:
+        cur.execute(f"TRUNCATE {', '.join(DATA_TABLES)};")
+
+
+def count_rows(table):
+    from db import cursor
+
+    with cursor() as cur:
+        cur.execute(sql.SQL('SELECT count(*) FROM {};').format(sql.Identifier(table)))
+        return cur.fetchone()[0]
+
+
+class StageTimer:
+    """Accumulates wall time and row counts per pipeline stage"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._entry(stage)['seconds'] += time.perf_counter() - start
+
+    def _entry(self, stage):
+        return self.stages.setdefault(stage, {'seconds': 0.0, 'rows': 0})
+
+    def add_rows(self, stage, rows):
+        self._entry(stage)['rows'] += rows
+
+    def report(self):
+        return {
+            stage: dict(entry, rows_per_sec=entry['rows'] / entry['seconds'] if entry['seconds'] else None)
+            for stage, entry in self.stages.items()}
+
+
+def random_filters(catalog, rng):
+    """One sidebar interaction: app default selections with one widget changed"""
+    years = catalog['contract_year']
+    filters = {
+        'start_year': years[0], 'end_year': years[-1], 'min_area': 0, 'max_area': 999999,
+        'type_of_area': catalog['type_of_area'], 'property_type': catalog['property_type'],
+        'tenure_type': catalog['tenure_type'], 'floor_range': catalog['floor_range'],
+        'type_of_sale': catalog['type_of_sale'],
+    }
+    widget = rng.choice(list(filters))
+    if widget in ('start_year', 'end_year'):
+        filters[widget] = rng.choice(years)
+    elif widget in ('min_area', 'max_area'):
+        filters[widget] = rng.randrange(0, 2000, 100) if widget == 'min_area' else rng.randrange(1000, 20000, 100)
+    else:
+        filters[widget] = rng.sample(filters[widget], rng.randint(1, len(filters[widget])))
+    return filters
+
+
+def run_size(n_transactions, transactions_per_project, seed, workdir):
+    """Runs every stage once on a fresh payload of n_transactions
+
+    Returns:
+        [dict]: stage -> seconds, rows and rows_per_sec
+    """
+    from extract_transactions import INGEST_CHUNK_SIZE, iter_projects, transform_transactions, load_rows
+    from update_coordinates import update_project_coordinates
+    from postgres_utils import update_proj_mrt_coordinates, refresh_dimension_catalog, get_dimension_catalog
+    from postgres_utils import get_aggregates, get_filtered_aggregates
+    from snapshot import write_snapshot, load_snapshot
+    from filter_engine import FilterEngine
+
+    timer = StageTimer()
+    n_projects = max(1, n_transactions // transactions_per_project)
+    truncate_data()
+
+    payload_path = os.path.join(workdir, f'payload_{n_transactions}.json')
+    with timer.time('generate'), open(payload_path, 'wb') as f:
+        payload_bytes = write_response(f, generate_projects(n_projects, transactions_per_project, seed))
+    timer.add_rows('generate', n_projects * transactions_per_project)
+    LOGGER.info(f'Generated {n_projects} projects, {payload_bytes / 2 ** 20:.1f}MB')
+
+    # Same chunking as fetch_batch, timed per stage
+    with open(payload_path, 'rb') as f:
+        projects = iter_projects(f)
+        while True:
+            with timer.time('json_decode'):
+                chunk = [project for _, project in zip(range(INGEST_CHUNK_SIZE), projects)]
+            if not chunk:
+                break
+            with timer.time('transform'):
+                proj_rows, trans_rows = transform_transactions(chunk)
+            timer.add_rows('json_decode', len(trans_rows))
+            timer.add_rows('transform', len(trans_rows))
+            with timer.time('load'):
+                if not load_rows(proj_rows, trans_rows):
+                    raise RuntimeError(f'Loading {len(trans_rows)} transactions failed, see log')
+            timer.add_rows('load', len(trans_rows))
+    os.remove(payload_path)
+    loaded = count_rows('private_residential_property_transactions')
+    if loaded != n_projects * transactions_per_project:
+        LOGGER.warning(f'Loaded {loaded} transactions, expected {n_projects * transactions_per_project}')
+
+    with timer.time('project_coordinates'):
+        update_project_coordinates()
+    timer.add_rows('project_coordinates', n_projects)
+    with timer.time('mrt_matching'):
+        update_proj_mrt_coordinates(refresh=True)
+    timer.add_rows('mrt_matching', n_projects)
+    with timer.time('dimension_catalog'):
+        refresh_dimension_catalog()
+    timer.add_rows('dimension_catalog', loaded)
+
+    snapshot_path = os.path.join(workdir, 'transactions_mrt.arrow')
+    with timer.time('snapshot_write'):
+        write_snapshot(snapshot_path)
+    timer.add_rows('snapshot_write', loaded)
+    with timer.time('snapshot_load'):
+        df, _ = load_snapshot(path=snapshot_path)
+    timer.add_rows('snapshot_load', len(df))
+    os.remove(snapshot_path)
+
+    rng = random.Random(seed)
+    catalog = get_dimension_catalog()
+    interactions = [random_filters(catalog, rng) for _ in range(BENCH_FILTER_CHANGES)]
+    with timer.time('filter_engine'):
+        engine = FilterEngine(df)
+        for filters in interactions:
+            timer.add_rows('filter_engine', len(engine.apply(filters)))
+    for stage, aggregate in (('aggregates_rollup', get_aggregates), ('aggregates_sql', get_filtered_aggregates)):
+        with timer.time(stage):
+            for filters in interactions[:10]:
+                for by in (('district',), ('mrt_name', 'contract_year')):
+                    timer.add_rows(stage, len(aggregate(filters, by)))
+    return dict(timer.report(), transactions={'rows': loaded})
+
+
+def get_environment():
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    from db import cursor
+
+    with cursor() as cur:
+        cur.execute('SHOW server_version;')
+        server_version = cur.fetchone()[0]
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'postgres': server_version,
+    }
+
+
+def compare(results, baseline):
+    """Logs the time ratio of every stage against a previous results file"""
+    for size, stages in results['sizes'].items():
+        base_stages = baseline['sizes'].get(size)
+        if base_stages is None:
+            continue
+        for stage, entry in stages.items():
+            base = base_stages.get(stage, {}).get('seconds')
+            if base and 'seconds' in entry:
+                LOGGER.info(
+                    f"{size:>8} {stage:<20} {base:9.3f}s -> {entry['seconds']:9.3f}s ({entry['seconds'] / base:5.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times ingestion, mrt matching and app aggregation on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES, help='transactions per run')
+    parser.add_argument('--transactions-per-project', type=int, default=BENCH_TRANSACTIONS_PER_PROJECT)
+    parser.add_argument('--stations', type=int, default=BENCH_STATIONS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='results filepath, defaults to benchmarks/results/<timestamp>_<commit>.json')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database')
+    args = parser.parse_args()
+    logging.basicConfig(level=LOG_LEVEL)
+
+    name = f"ura_bench_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{os.getpid()}"
+    results = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'transactions_per_project': args.transactions_per_project,
+            'stations': args.stations,
+            'seed': args.seed,
+        },
+        'sizes': {},
+    }
+    with bench_database(name, keep=args.keep), tempfile.TemporaryDirectory() as workdir:
+        create_schema(args.stations, args.seed)
+        results['environment'] = get_environment()
+        for size in args.sizes:
+            LOGGER.info(f'Benchmarking {size} transactions')
+            results['sizes'][str(size)] = run_size(size, args.transactions_per_project, args.seed, workdir)
+
+    commit = (results['environment']['commit'] or 'unknown')[:8]
+    path = args.output or os.path.join(
+        BENCH_RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    LOGGER.info(f'Wrote benchmark results to {path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
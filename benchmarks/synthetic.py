@@ -0,0 +1,100 @@
+import json
+import random
+import datetime
+
+# Rough SVY21 extent of mainland Singapore
+SVY21_X_RANGE = (8000.0, 45000.0)
+SVY21_Y_RANGE = (26000.0, 48000.0)
+LONGITUDE_RANGE = (103.62, 104.0)
+LATITUDE_RANGE = (1.25, 1.45)
+
+STREETS = ['ORCHARD BOULEVARD', 'ST. THOMAS WALK', 'ST. MICHAEL\'S ROAD', 'HOLLAND ROAD', 'BUKIT TIMAH ROAD',
+           'UPPER SERANGOON ROAD', 'JALAN KEMBANGAN', 'TAMPINES AVENUE', 'PASIR RIS DRIVE', 'JURONG WEST STREET']
+FLOOR_RANGES = ['-', '01-05', '06-10', '11-15', '16-20', '21-25', '26-30', '31-35', '36-40', 'B1-B5']
+PROPERTY_TYPES = ['Condominium', 'Apartment', 'Executive Condominium', 'Terrace', 'Semi-detached', 'Detached', 'Strata Terrace']
+TENURES = ['Freehold', 'NA', '99 yrs lease commencing from {year}', '999 yrs lease commencing from 1885',
+           '60 yrs lease commencing from {year}', '103 yrs lease commencing from {year}', '956 yrs lease commencing from 1928']
+
+
+def contract_dates(years=5, today=None):
+    """Every MMYY contract date URA returns for the past years"""
+    today = today or datetime.date.today()
+    dates = []
+    for offset in range(years * 12):
+        month = (today.month - 1 - offset) % 12 + 1
+        year = today.year - (offset + 12 - today.month) // 12
+        dates.append(f'{month:02d}{year % 100:02d}')
+    return dates
+
+
+def generate_projects(n_projects, transactions_per_project=50, seed=0):
+    """Yields synthetic projects shaped like the PMI_Resi_Transaction Result array
+
+    Args:
+        n_projects (int): number of projects
+        transactions_per_project (int): transactions per project
+        seed (int): random seed, the same seed yields the same payload
+
+    Yields:
+        [dict]: project with street, x, y and a transaction list
+    """
+    rng = random.Random(seed)
+    dates = contract_dates()
+    for i in range(n_projects):
+        street = f'{rng.choice(STREETS)} {rng.randint(1, 90)}'
+        district = f'{rng.randint(1, 28):02d}'
+        property_type = rng.choice(PROPERTY_TYPES)
+        type_of_area = 'Land' if property_type in ('Terrace', 'Semi-detached', 'Detached') else 'Strata'
+        tenure = rng.choice(TENURES).format(year=rng.randint(1960, 2020))
+        base_psf = rng.uniform(800, 3500)
+        transactions = []
+        for _ in range(transactions_per_project):
+            area = rng.uniform(35, 400) if type_of_area == 'Strata' else rng.uniform(120, 1500)
+            transactions.append({
+                'area': f'{area:.1f}',
+                'floorRange': rng.choice(FLOOR_RANGES) if type_of_area == 'Strata' else '-',
+                'noOfUnits': '1',
+                'contractDate': rng.choice(dates),
+                'typeOfSale': rng.choice('123'),
+                'price': str(int(area * 10.764 * base_psf * rng.uniform(0.85, 1.15) / 1000) * 1000),
+                'propertyType': property_type,
+                'district': district,
+                'typeOfArea': type_of_area,
+                'tenure': tenure,
+            })
+        yield {
+            'project': f'SYNTHETIC RESIDENCES {i}',
+            'street': street,
+            'x': f'{rng.uniform(*SVY21_X_RANGE):.4f}',
+            'y': f'{rng.uniform(*SVY21_Y_RANGE):.4f}',
+            'marketSegment': rng.choice(['CCR', 'RCR', 'OCR']),
+            'transaction': transactions,
+        }
+
+
+def generate_stations(n_stations, seed=0):
+    """Synthetic mrt stations as (id, name, type, longitude, latitude) rows"""
+    rng = random.Random(seed)
+    return [
+        (f'S{i}', f'SYNTHETIC STATION {i}', 'MRT', rng.uniform(*LONGITUDE_RANGE), rng.uniform(*LATITUDE_RANGE))
+        for i in range(n_stations)]
+
+
+def write_response(f, projects):
+    """Streams projects to f as a URA PMI_Resi_Transaction response body,
+       one project at a time so large payloads never sit in memory
+
+    Args:
+        f (file): binary file to write to
+        projects (iterable): projects, e.g. from generate_projects
+
+    Returns:
+        [int]: bytes written
+    """
+    written = f.write(b'{"Status": "Success", "Message": "", "Result": [')
+    for i, project in enumerate(projects):
+        if i:
+            written += f.write(b', ')
+        written += f.write(json.dumps(project).encode('utf-8'))
+    written += f.write(b']}')
+    return written
@@ -1,25 +1,20 @@
 import os
+import sys
+import json
 import logging
+import datetime
 import psycopg2 as pg
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from db import cursor  # noqa: E402
+from postgres_utils import ROLLUP_DIMENSIONS, rollup_merge_sql  # noqa: E402
+from postgres_utils import ensure_transaction_partitions, explain_queries, get_app_queries  # noqa: E402
+
 LOGGER = logging.getLogger(__name__)
 
 load_dotenv()
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
-POSTGRES_DB = os.getenv('POSTGRES_DB', 'postgres')
-POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
-POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
-
-params = {
-    'host': POSTGRES_HOST,
-    'port': POSTGRES_PORT,
-    'user': POSTGRES_USER,
-    'password': POSTGRES_PASSWORD,
-    'dbname': POSTGRES_DB
-}
 
 
 def create_mrt_table():
@@ -34,18 +29,11 @@ def create_mrt_table():
         '    CONSTRAINT mrt_pk PRIMARY KEY (name, id)'
         ');'
     )
-    conn = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        conn.commit()
-        cur.close()
+        with cursor() as cur:
+            cur.execute(query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
 def create_postal_districts_table():
@@ -59,18 +47,11 @@ def create_postal_districts_table():
         '    CONSTRAINT postal_districts_pk PRIMARY KEY (name)'
         ');'
     )
-    conn = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        conn.commit()
-        cur.close()
+        with cursor() as cur:
+            cur.execute(query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
 def create_projects_table():
@@ -93,19 +74,12 @@ def create_projects_table():
         'ADD CONSTRAINT private_residential_property_projects_fk FOREIGN KEY (mrt_name, mrt_id) '
         'REFERENCES mrt(name, id);'
     )
-    conn = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query1)
-        cur.execute(query2)
-        conn.commit()
-        cur.close()
+        with cursor() as cur:
+            cur.execute(query1)
+            cur.execute(query2)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
 def create_transactions_table():
@@ -139,20 +113,349 @@ def create_transactions_table():
     query3 = (
         'CREATE INDEX private_residential_property_transactions_project_idx ON public.private_residential_property_transactions USING btree (project, street);'
     )
-    conn = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query1)
-        cur.execute(query2)
-        cur.execute(query3)
-        conn.commit()
-        cur.close()
+        with cursor() as cur:
+            cur.execute(query1)
+            cur.execute(query2)
+            cur.execute(query3)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+
+
+def create_ingestion_state_tables():
+    query1 = (
+        'CREATE TABLE public.ingestion_batches ('
+        '    batch integer NOT NULL,'
+        '    content_hash varchar NOT NULL,'
+        '    updated_at timestamp NOT NULL DEFAULT now(),'
+        '    CONSTRAINT ingestion_batches_pk PRIMARY KEY (batch)'
+        ');'
+    )
+    query2 = (
+        'CREATE TABLE public.ingestion_watermarks ('
+        '    project varchar NOT NULL,'
+        '    street varchar NOT NULL,'
+        '    contract_date date NOT NULL,'
+        '    CONSTRAINT ingestion_watermarks_pk PRIMARY KEY (project, street)'
+        ');'
+    )
+    try:
+        with cursor() as cur:
+            cur.execute(query1)
+            cur.execute(query2)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+
+
+def create_geocode_cache_table():
+    query = (
+        'CREATE TABLE public.geocode_cache ('
+        '    kind varchar NOT NULL,'
+        '    key varchar NOT NULL,'
+        '    response jsonb NOT NULL,'
+        '    fetched_at timestamp NOT NULL DEFAULT now(),'
+        '    CONSTRAINT geocode_cache_pk PRIMARY KEY (kind, key)'
+        ');'
+    )
+    try:
+        with cursor() as cur:
+            cur.execute(query)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+
+
+def create_data_generation_table():
+    """Creates the single row counter writers bump whenever the transactions/mrt
+       join changes, the snapshot data version includes it
+    """
+    query1 = (
+        'CREATE TABLE public.data_generation ('
+        '    id boolean NOT NULL DEFAULT true,'
+        '    generation bigint NOT NULL DEFAULT 0,'
+        '    updated_at timestamp NOT NULL DEFAULT now(),'
+        '    CONSTRAINT data_generation_pk PRIMARY KEY (id),'
+        '    CONSTRAINT data_generation_single_row CHECK (id)'
+        ');'
+    )
+    query2 = 'INSERT INTO public.data_generation DEFAULT VALUES;'
+    try:
+        with cursor() as cur:
+            cur.execute(query1)
+            cur.execute(query2)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+
+
+def create_dimension_catalog_table():
+    query = (
+        'CREATE TABLE public.dimension_catalog ('
+        '    dimension varchar NOT NULL,'
+        '    value varchar NOT NULL,'
+        '    row_count bigint NOT NULL,'
+        '    updated_at timestamp NOT NULL DEFAULT now(),'
+        '    CONSTRAINT dimension_catalog_pk PRIMARY KEY (dimension, value)'
+        ');'
+    )
+    try:
+        with cursor() as cur:
+            cur.execute(query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn is not None:
-            conn.close()
+
+
+def get_transactions_rollup_table_query():
+    dims = ''.join(f"    {dim} varchar NOT NULL DEFAULT ''," for dim in ROLLUP_DIMENSIONS)
+    return (
+        'CREATE TABLE public.transactions_rollup ('
+        "    mrt_id varchar NOT NULL DEFAULT '',"
+        "    mrt_name varchar NOT NULL DEFAULT '',"
+        '    contract_year integer NOT NULL,'
+        f'{dims}'
+        '    transactions bigint NOT NULL,'
+        '    no_of_units numeric NOT NULL,'
+        '    area numeric NOT NULL,'
+        '    price numeric NOT NULL,'
+        '    CONSTRAINT transactions_rollup_pk PRIMARY KEY ('
+        f"        mrt_id, mrt_name, contract_year, {', '.join(ROLLUP_DIMENSIONS)}"
+        '    )'
+        ');'
+    )
+
+
+def create_transactions_rollup_table():
+    """Creates an empty rollup, it is filled by the rollup_by_mrt migration"""
+    try:
+        with cursor() as cur:
+            cur.execute(get_transactions_rollup_table_query())
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+
+
+def get_table_sizes(cur, tables):
+    """Total size in bytes (heap, indexes and toast) of each table, including its partitions"""
+    cur.execute(
+        'SELECT t, COALESCE((SELECT sum(pg_total_relation_size(relid))::bigint FROM pg_partition_tree(t::regclass)), '
+        '    pg_total_relation_size(t::regclass)) '
+        'FROM unnest(%s::text[]) AS t;',
+        (list(tables),))
+    return dict(cur.fetchall())
+
+
+def alter_column_types(cur, table, types):
+    """Changes the columns of table whose type differs from types in a single
+       ALTER TABLE, so the table is rewritten at most once
+
+    Args:
+        cur (cursor): open psycopg2 cursor
+        table (str): table name
+        types (dict): column -> type as reported by information_schema.columns.data_type
+    """
+    cur.execute(
+        'SELECT column_name, data_type FROM information_schema.columns '
+        "WHERE table_schema = 'public' AND table_name = %s;",
+        (table,))
+    current = dict(cur.fetchall())
+    changes = [
+        f'ALTER COLUMN {column} TYPE {data_type} USING {column}::{data_type}'
+        for column, data_type in types.items() if current.get(column) != data_type]
+    if changes:
+        cur.execute(f"ALTER TABLE public.{table} {', '.join(changes)};")
+
+
+def migrate_compact_numeric_types(cur):
+    """area and psf are floored sqft values and prices are whole dollars, none need numeric"""
+    alter_column_types(cur, 'private_residential_property_transactions', {
+        'area': 'integer',
+        'no_of_units': 'smallint',
+        'price': 'bigint',
+        'psf': 'integer',
+    })
+    alter_column_types(cur, 'private_residential_property_projects', {
+        'x': 'double precision',
+        'y': 'double precision',
+        'latitude': 'double precision',
+        'longitude': 'double precision',
+        'mrt_dist': 'double precision',
+    })
+    alter_column_types(cur, 'mrt', {
+        'longitude': 'double precision',
+        'latitude': 'double precision',
+    })
+    alter_column_types(cur, 'postal_districts', {
+        'latitude': 'double precision',
+        'longitude': 'double precision',
+    })
+
+
+def migrate_project_surrogate_id(cur):
+    """Joins transactions to projects on an integer project_id instead of two varchars.
+       A trigger fills project_id on insert so every loader keeps working unchanged.
+    """
+    cur.execute(
+        'ALTER TABLE public.private_residential_property_projects '
+        'ADD COLUMN IF NOT EXISTS project_id integer GENERATED BY DEFAULT AS IDENTITY;')
+    cur.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS private_residential_property_projects_project_id_idx '
+        'ON public.private_residential_property_projects USING btree (project_id);')
+    cur.execute(
+        'ALTER TABLE public.private_residential_property_transactions '
+        'ADD COLUMN IF NOT EXISTS project_id integer;')
+    cur.execute(
+        'UPDATE private_residential_property_transactions prpt '
+        'SET project_id = prpp.project_id '
+        'FROM private_residential_property_projects prpp '
+        'WHERE prpp.project = prpt.project AND prpp.street = prpt.street '
+        '    AND prpt.project_id IS DISTINCT FROM prpp.project_id;')
+    # The UPDATE leaves a dead copy of every row, rewrite the table to reclaim it
+    cur.execute(
+        'ALTER TABLE public.private_residential_property_transactions '
+        'ALTER COLUMN project_id TYPE integer USING project_id + 0;')
+    cur.execute(
+        'CREATE OR REPLACE FUNCTION set_transaction_project_id() RETURNS trigger AS $$ '
+        'BEGIN '
+        '    SELECT project_id INTO NEW.project_id '
+        '    FROM private_residential_property_projects '
+        '    WHERE project = NEW.project AND street = NEW.street; '
+        '    RETURN NEW; '
+        'END; '
+        '$$ LANGUAGE plpgsql;')
+    cur.execute(
+        'DROP TRIGGER IF EXISTS private_residential_property_transactions_project_id '
+        'ON public.private_residential_property_transactions;')
+    cur.execute(
+        'CREATE TRIGGER private_residential_property_transactions_project_id '
+        'BEFORE INSERT OR UPDATE OF project, street ON public.private_residential_property_transactions '
+        'FOR EACH ROW EXECUTE FUNCTION set_transaction_project_id();')
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS private_residential_property_transactions_project_id_idx '
+        'ON public.private_residential_property_transactions USING btree (project_id);')
+
+
+def migrate_partition_transactions(cur):
+    """Range partitions the transactions table by contract year so year filters
+       prune whole partitions, adds a BRIN index on contract_date and a covering
+       index for area filtered aggregates, and reports the app queries' plans
+       before and after
+    """
+    table = 'private_residential_property_transactions'
+    cur.execute(
+        f'SELECT EXTRACT(YEAR FROM min(contract_date))::int, EXTRACT(YEAR FROM max(contract_date))::int FROM {table};')
+    first_year, last_year = cur.fetchone()
+    this_year = datetime.date.today().year
+    first_year = first_year or this_year - 5
+    last_year = last_year or this_year
+    queries = get_app_queries({'start_year': last_year - 2, 'end_year': last_year, 'min_area': 500, 'max_area': 1499})
+    cur.execute(f'ANALYZE {table};')
+    before = explain_queries(cur, queries)
+
+    cur.execute(f"SELECT relkind FROM pg_class WHERE oid = to_regclass('{table}');")
+    if cur.fetchone()[0] != 'p':
+        cur.execute(f'ALTER TABLE public.{table} RENAME TO {table}_unpartitioned;')
+        cur.execute(
+            f'CREATE TABLE public.{table} (LIKE public.{table}_unpartitioned INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE (contract_date);')
+        ensure_transaction_partitions(cur, range(first_year, max(last_year, this_year) + 1))
+        cur.execute(f'INSERT INTO public.{table} SELECT * FROM public.{table}_unpartitioned;')
+        cur.execute(f'DROP TABLE public.{table}_unpartitioned;')
+        cur.execute(
+            f'ALTER TABLE public.{table} ADD CONSTRAINT {table}_pk PRIMARY KEY ('
+            '    project, street, area, floor_range, contract_date, type_of_sale, price);')
+        cur.execute(
+            f'ALTER TABLE public.{table} ADD CONSTRAINT {table}_fk FOREIGN KEY (project, street) '
+            'REFERENCES private_residential_property_projects(project, street);')
+        cur.execute(f'CREATE INDEX {table}_project_idx ON public.{table} USING btree (project, street);')
+        cur.execute(f'CREATE INDEX {table}_project_id_idx ON public.{table} USING btree (project_id);')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS {table}_contract_date_idx ON public.{table} USING brin (contract_date);')
+    cur.execute(
+        f'CREATE INDEX IF NOT EXISTS {table}_area_idx ON public.{table} USING btree (area) '
+        'INCLUDE (project_id, contract_date, district, no_of_units, price);')
+    cur.execute(f'ANALYZE {table};')
+    after = explain_queries(cur, queries)
+    for name in queries:
+        LOGGER.info(f"{name}: {before[name]['execution_ms']}ms -> {after[name]['execution_ms']}ms")
+    LOGGER.info(f'Run VACUUM ANALYZE {table} so the covering index can serve index only scans')
+    return {'explain': {name: {'before': before[name], 'after': after[name]} for name in queries}}
+
+
+def migrate_rollup_by_mrt(cur):
+    """Rekeys transactions_rollup from project, street and area bucket to the
+       project's nearest mrt, so the projects around a station share cells
+    """
+    cur.execute('SELECT count(*) FROM transactions_rollup;')
+    cells_before = cur.fetchone()[0]
+    cur.execute('DROP TABLE IF EXISTS public.transactions_rollup;')
+    cur.execute(get_transactions_rollup_table_query())
+    cur.execute(rollup_merge_sql('private_residential_property_transactions') + ';')
+    cur.execute('SELECT count(*), COALESCE(sum(transactions), 0) FROM transactions_rollup;')
+    cells_after, transactions = cur.fetchone()
+    LOGGER.info(f'Rollup cells: {cells_before} -> {cells_after} for {transactions} transactions')
+    return {'rollup_cells': {'before': cells_before, 'after': cells_after, 'transactions': int(transactions)}}
+
+
+# Ordered, append only: (version, name, tables reported on, migration)
+MIGRATIONS = [
+    (1, 'compact_numeric_types', [
+        'private_residential_property_transactions', 'private_residential_property_projects',
+        'mrt', 'postal_districts'], migrate_compact_numeric_types),
+    (2, 'project_surrogate_id', [
+        'private_residential_property_transactions', 'private_residential_property_projects'],
+        migrate_project_surrogate_id),
+    (3, 'partition_transactions_by_year', ['private_residential_property_transactions'], migrate_partition_transactions),
+    (4, 'rollup_by_mrt', ['transactions_rollup'], migrate_rollup_by_mrt),
+]
+
+
+def create_schema_migrations_table():
+    query = (
+        'CREATE TABLE IF NOT EXISTS public.schema_migrations ('
+        '    version integer NOT NULL,'
+        '    name varchar NOT NULL,'
+        '    applied_at timestamp NOT NULL DEFAULT now(),'
+        '    report jsonb NULL,'
+        '    CONSTRAINT schema_migrations_pk PRIMARY KEY (version)'
+        ');'
+    )
+    try:
+        with cursor() as cur:
+            cur.execute(query)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+
+
+def run_migrations(migrations=MIGRATIONS):
+    """Applies every migration newer than the recorded schema version, each in
+       its own transaction together with its schema_migrations row, and
+       records the size of the tables it touches before and after along with
+       any report the migration returns
+
+    Returns:
+        [list]: versions applied by this run
+    """
+    applied = []
+    for version, name, tables, migrate in migrations:
+        try:
+            with cursor() as cur:
+                cur.execute('LOCK TABLE schema_migrations IN SHARE ROW EXCLUSIVE MODE;')
+                cur.execute('SELECT 1 FROM schema_migrations WHERE version = %s;', (version,))
+                if cur.fetchone():
+                    continue
+                LOGGER.info(f'Applying migration {version} {name}')
+                before = get_table_sizes(cur, tables)
+                extra = migrate(cur)
+                after = get_table_sizes(cur, tables)
+                report = {table: {'bytes_before': before[table], 'bytes_after': after[table]} for table in tables}
+                cur.execute(
+                    'INSERT INTO schema_migrations (version, name, report) VALUES (%s, %s, %s);',
+                    (version, name, json.dumps(dict(report, **(extra or {})))))
+            for table, sizes in report.items():
+                LOGGER.info(
+                    f"Migration {version} {table}: {sizes['bytes_before'] / 2 ** 20:.1f}MB -> "
+                    f"{sizes['bytes_after'] / 2 ** 20:.1f}MB")
+            applied.append(version)
+        except (pg.Error) as e:
+            LOGGER.exception(e)
+            break
+    return applied
 
 
 if __name__ == '__main__':
@@ -162,3 +465,10 @@ if __name__ == '__main__':
     create_mrt_table()
     create_projects_table()
     create_transactions_table()
+    create_ingestion_state_tables()
+    create_geocode_cache_table()
+    create_data_generation_table()
+    create_dimension_catalog_table()
+    create_transactions_rollup_table()
+    create_schema_migrations_table()
+    run_migrations()
@@ -3,28 +3,73 @@ import os
 import streamlit as st
 import pydeck as pdk
 import altair as alt
+import pandas as pd
 from dotenv import load_dotenv
-from postgres_utils import get_property_type_labels, get_contract_date_years, get_tenure_type_labels, get_area_type_labels, get_postal_districts_data, get_sale_type_labels, get_floor_range_labels, get_transactions_mrt_data, get_mrt_name_labels
+from db import log_pool_stats
+from query_log import get_query_stats, log_query_stats
+from snapshot import get_data_version, load_snapshot
+from filter_engine import FilterEngine
+from postgres_utils import get_dimension_catalog, refresh_dimension_catalog, get_postal_districts_data, get_filtered_transactions_mrt_data, get_aggregates
 
 LOGGER = logging.getLogger(__name__)
 
 load_dotenv()
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 MAPBOX_STYLE = os.getenv('MAPBOX_STYLE', 'mapbox://styles/caisho/ckhzpiwfm1x7419pujepchs2x')
-AREA_TYPES = get_area_type_labels()
-PROPERTY_TYPES = get_property_type_labels()
-TRANSACTION_YEARS = get_contract_date_years()
-TENURE_TYPES = get_tenure_type_labels()
-SALE_TYPES = get_sale_type_labels()
-FLOOR_RANGE_TYPES = get_floor_range_labels()
-MRT_NAME_TYPES = get_mrt_name_labels()
+SNAPSHOT_CHECK_TTL = int(os.getenv('SNAPSHOT_CHECK_TTL', '60'))
+QUERY_CACHE_ENTRIES = int(os.getenv('QUERY_CACHE_ENTRIES', '64'))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '3600'))
 
 logging.basicConfig(level=LOG_LEVEL)
 
+CATALOG = get_dimension_catalog()
+if not CATALOG['contract_year']:
+    LOGGER.warning('Dimension catalog is empty, rebuilding it from the transactions table')
+    refresh_dimension_catalog()
+    CATALOG = get_dimension_catalog()
+AREA_TYPES = CATALOG['type_of_area']
+PROPERTY_TYPES = CATALOG['property_type']
+TRANSACTION_YEARS = CATALOG['contract_year']
+TENURE_TYPES = CATALOG['tenure_type']
+SALE_TYPES = CATALOG['type_of_sale']
+FLOOR_RANGE_TYPES = CATALOG['floor_range']
+MRT_NAME_TYPES = CATALOG['mrt_name']
+log_pool_stats()
+
+
+@st.cache(ttl=SNAPSHOT_CHECK_TTL)
+def get_postgres_data_version():
+    return get_data_version()
+
+
+class SnapshotUnavailable(Exception):
+    """Raised instead of returning a miss, st.cache does not cache exceptions"""
+
+
+# One entry each, the previous version's frame and masks are released once a new version loads
+@st.cache(allow_output_mutation=True, max_entries=1)
+def get_snapshot_data(version):
+    df_snapshot, snapshot_version = load_snapshot(version)
+    if df_snapshot is None:
+        raise SnapshotUnavailable(version)
+    return df_snapshot, snapshot_version
 
-@st.cache
-def get_postgres_transactions_data():
-    return get_transactions_mrt_data()
+
+@st.cache(allow_output_mutation=True, max_entries=1)
+def get_filter_engine(version):
+    df_snapshot, snapshot_version = get_snapshot_data(version)
+    return FilterEngine(df_snapshot), snapshot_version
+
+
+# version is only part of the cache key, results cached for an older data version are never hit again
+@st.cache(max_entries=QUERY_CACHE_ENTRIES, ttl=QUERY_CACHE_TTL)
+def get_postgres_transactions_data(filters, version):
+    return get_filtered_transactions_mrt_data(filters)
+
+
+@st.cache(max_entries=QUERY_CACHE_ENTRIES, ttl=QUERY_CACHE_TTL)
+def get_postgres_aggregates(filters, by, version):
+    return get_aggregates(filters, by)
 
 
 @st.cache
@@ -32,12 +77,8 @@ def get_postgres_districts_data():
     return get_postal_districts_data()
 
 
-def aggregate_data(df, by):
-    df_agg = df.groupby(by).agg(
-        {'no_of_units': 'sum',
-         'area': 'sum',
-         'price': 'sum'
-         })
+def summarise_data(df_agg):
+    df_agg = df_agg.copy()
     df_agg['area_mean'] = df_agg['area'] / df_agg['no_of_units']
     df_agg['price_mean'] = df_agg['price'] / df_agg['no_of_units']
     df_agg['psf_mean'] = df_agg['price'] / df_agg['area']
@@ -102,31 +143,46 @@ mrt_name_type = st.sidebar.multiselect(
     default=['SIGLAP']
 )
 
+show_query_stats = st.sidebar.checkbox('Show query stats')
+
 # Body
 st.title('URA Private Residential Property Transactions')
 
-df = get_postgres_transactions_data()
-df_filtered = df.loc[
-    (df['contract_year'] >= start_year) &
-    (df['contract_year'] <= end_year) &
-    (df['area'] >= min_area) &
-    (df['area'] <= max_area) &
-    (df['type_of_area'].isin(area_type)) &
-    (df['property_type'].isin(property_type)) &
-    (df['tenure_type'].isin(tenure_type)) &
-    (df['floor_range'].isin(floor_range_type)) &
-    (df['type_of_sale'].isin(sale_type))]
+filters = {
+    'start_year': start_year,
+    'end_year': end_year,
+    'min_area': min_area,
+    'max_area': max_area,
+    'type_of_area': area_type,
+    'property_type': property_type,
+    'tenure_type': tenure_type,
+    'floor_range': floor_range_type,
+    'type_of_sale': sale_type,
+}
+data_version = get_postgres_data_version()
+try:
+    filter_engine, snapshot_version = get_filter_engine(data_version)
+except SnapshotUnavailable:
+    # Retried on the next rerun, e.g. once write_snapshot catches up with the data version
+    filter_engine, snapshot_version = None, None
+if filter_engine is not None:
+    df_filtered = filter_engine.apply(filters)
+    LOGGER.info(f'Serving transactions from snapshot version {snapshot_version}')
+else:
+    df_filtered = get_postgres_transactions_data(filters, data_version)
+    LOGGER.info(f'Snapshot missing or stale, serving transactions from Postgres version {data_version}')
+st.sidebar.text(f"Data version: {(data_version or 'unknown')[:8]} ({'snapshot' if filter_engine is not None else 'postgres'})")
 
 st.subheader('Individual Transactions')
 st.write(df_filtered)
 st.write(f'Total Transactions: {len(df_filtered)}')
 
 st.subheader('Transactions by District')
-df_district_grp = aggregate_data(df_filtered, ['district'])
+df_district_grp = summarise_data(get_postgres_aggregates(filters, ('district',), data_version))
 st.write(df_district_grp)
 
 st.subheader('Transactions by MRT')
-df_mrt_grp = aggregate_data(df_filtered, ['mrt_name', 'contract_year'])
+df_mrt_grp = summarise_data(get_postgres_aggregates(filters, ('mrt_name', 'contract_year'), data_version))
 st.write(df_mrt_grp)
 
 st.subheader('Average PSF by MRT and Year')
@@ -168,4 +224,10 @@ st.pydeck_chart(pdk.Deck(
             get_alignment_baseline="'top'",
         ),
     ],
-))
\ No newline at end of file
+))
+
+# After every query of this run, cached results do not reach Postgres and are not counted
+if show_query_stats:
+    log_query_stats()
+    st.sidebar.subheader('Query stats since start')
+    st.sidebar.table(pd.DataFrame.from_dict(get_query_stats(), orient='index'))
@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from psycopg2.extensions import cursor as _cursor
+from psycopg2.pool import ThreadedConnectionPool
+from metrics import record
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+POSTGRES_DB = os.getenv('POSTGRES_DB', 'postgres')
+POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
+POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
+POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
+POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', '1'))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', '8'))
+
+
+class CountingCursor(_cursor):
+    """Cursor recording every statement, COPY and server-side cursor fetch as a
+       DB round trip of the current metrics stage. execute_values counts once per page.
+    """
+
+    def execute(self, query, vars=None):
+        record(db_round_trips=1)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        record(db_round_trips=len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        record(db_round_trips=1)
+        return super().copy_expert(sql, file, size)
+
+    def fetchone(self):
+        if self.name is not None:
+            record(db_round_trips=1)
+        return super().fetchone()
+
+    def fetchmany(self, size=None):
+        if self.name is not None:
+            record(db_round_trips=1)
+        return super().fetchmany() if size is None else super().fetchmany(size)
+
+    def fetchall(self):
+        if self.name is not None:
+            record(db_round_trips=1)
+        return super().fetchall()
+
+
+params = {
+    'host': POSTGRES_HOST,
+    'port': POSTGRES_PORT,
+    'user': POSTGRES_USER,
+    'password': POSTGRES_PASSWORD,
+    'dbname': POSTGRES_DB,
+    'cursor_factory': CountingCursor,
+}
+
+
+class ConnectionPool:
+    """Thread-safe Postgres connection pool that blocks, rather than raising,
+       when all maxconn connections are checked out, and tracks utilization.
+    """
+
+    def __init__(self, minconn=POSTGRES_POOL_MIN, maxconn=POSTGRES_POOL_MAX, **kwargs):
+        self.maxconn = maxconn
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+
+    def getconn(self):
+        start = time.perf_counter()
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self.wait_time += time.perf_counter() - start
+        return conn
+
+    def putconn(self, conn, close=False):
+        try:
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max': self.maxconn,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'utilization': self.in_use / self.maxconn,
+                'checkouts': self.checkouts,
+                'avg_wait_ms': 1000 * self.wait_time / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process wide pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(**params)
+            LOGGER.info(f'Created Postgres pool min={POSTGRES_POOL_MIN} max={POSTGRES_POOL_MAX}')
+        return _pool
+
+
+@contextmanager
+def connection():
+    """Checks a connection out of the pool, commits on success and rolls back on error"""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+        record(db_round_trips=1)
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+@contextmanager
+def cursor(name=None):
+    """Yields a cursor on a pooled connection, a named (server-side) cursor if name is given"""
+    with connection() as conn:
+        cur = conn.cursor(name=name) if name else conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def log_pool_stats():
+    stats = get_pool().stats()
+    LOGGER.info(
+        f"Postgres pool in use = {stats['in_use']}/{stats['max']}, peak = {stats['peak_in_use']}, "
+        f"checkouts = {stats['checkouts']}, avg wait = {stats['avg_wait_ms']:.1f}ms")
@@ -1,12 +1,29 @@
 import os
-import math
+import io
+import csv
+import time
+import queue
+import datetime
+import hashlib
+import tempfile
 import requests
 import logging
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import psycopg2 as pg
+from psycopg2.extras import execute_values
+from db import cursor, log_pool_stats
+import metrics
+from metrics import stage, record
+from snapshot import write_snapshot
 from update_coordinates import update_project_coordinates
-from postgres_utils import update_proj_mrt_coordinates, extract_mrt_coordinates, extract_postal_districts
-from utils import get_tenure_type, convert_abbreviation, format_date
+from postgres_utils import update_proj_mrt_coordinates, extract_mrt_coordinates, extract_postal_districts, refresh_dimension_catalog, rollup_merge_sql
+from postgres_utils import bump_data_generation, ensure_transaction_partitions
+import numpy as np
+from utils import iter_json_array
+from utils import map_distinct, cached_contract_date, cached_convert_abbreviation, cached_get_tenure_type
 
 LOGGER = logging.getLogger(__name__)
 
@@ -15,19 +32,22 @@ LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 URA_ACCESS_KEY = os.getenv('URA_ACCESS_KEY')
 URA_TOKEN_URL = os.getenv('URA_TOKEN_URL', 'https://www.ura.gov.sg/uraDataService/insertNewToken.action')
 URA_PROPERTY_URL = os.getenv('URA_PROPERTY_URL', 'https://www.ura.gov.sg/uraDataService/invokeUraDS')
-POSTGRES_DB = os.getenv('POSTGRES_DB', 'postgres')
-POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
-POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
+URA_BATCHES = range(1, 5, 1)
+URA_FETCH_WORKERS = int(os.getenv('URA_FETCH_WORKERS', '4'))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '8'))
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '500'))
+URA_STREAM_CHUNK_SIZE = 64 * 1024
+URA_SPOOL_SIZE = int(os.getenv('URA_SPOOL_SIZE', str(8 * 1024 * 1024)))
+# URA publishes some transactions months after their contract date
+INGEST_WATERMARK_LOOKBACK_MONTHS = int(os.getenv('INGEST_WATERMARK_LOOKBACK_MONTHS', '6'))
 
-params = {
-    'host': POSTGRES_HOST,
-    'port': POSTGRES_PORT,
-    'user': POSTGRES_USER,
-    'password': POSTGRES_PASSWORD,
-    'dbname': POSTGRES_DB
-}
+PROJECT_COLUMNS = ['project', 'street', 'x', 'y']
+TRANSACTION_COLUMNS = [
+    'project', 'street', 'area', 'floor_range',
+    'no_of_units', 'contract_date', 'type_of_sale',
+    'price', 'property_type', 'district', 'type_of_area',
+    'tenure', 'psf', 'tenure_type'
+]
 
 
 def get_token(url, access_key):
@@ -35,12 +55,29 @@ def get_token(url, access_key):
     r = requests.get(
         url=url,
         headers=headers)
+    record(http_bytes=len(r.content))
     if r.status_code == requests.codes.ok:
         return r.json().get('Result')
+    LOGGER.warning(f'URA token request returned status {r.status_code}')
+    record(errors=1)
     return None
 
 
-def get_private_residential_transactions(url, access_key, token, batch=1):
+def download_batch(url, access_key, token, batch=1, chunk_size=URA_STREAM_CHUNK_SIZE):
+    """Streams a PMI_Resi_Transaction batch into a spooled temp file while
+       hashing its content, the body spills to disk past URA_SPOOL_SIZE bytes
+
+    Args:
+        url (str): URA data service url
+        access_key (str): URA access key
+        token (str): URA daily token
+        batch (int): URA batch number
+        chunk_size (int): bytes read from the response per iteration
+
+    Returns:
+        [tuple]: (file positioned at the start of the body, sha256 hex digest),
+            or (None, None) if the request failed
+    """
     headers = {
         'AccessKey': access_key,
         'Token': token}
@@ -48,87 +85,374 @@ def get_private_residential_transactions(url, access_key, token, batch=1):
         'service': 'PMI_Resi_Transaction',
         'batch': batch
     }
-    r = requests.get(
-        url=url,
-        headers=headers,
-        params=payload)
-    if r.status_code == requests.codes.ok:
-        return r.json().get('Result')
-    return None
+    with requests.get(url=url, headers=headers, params=payload, stream=True) as r:
+        if r.status_code != requests.codes.ok:
+            LOGGER.warning(f'URA batch {batch} returned status {r.status_code}')
+            return None, None
+        sha = hashlib.sha256()
+        f = tempfile.SpooledTemporaryFile(max_size=URA_SPOOL_SIZE)
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            sha.update(chunk)
+            f.write(chunk)
+            record(http_bytes=len(chunk))
+    f.seek(0)
+    return f, sha.hexdigest()
 
 
-def extract_transactions(data):
-    proj_query = (
-        'INSERT INTO private_residential_property_projects (project, street, x, y)'
-        'VALUES'
-        '    (%s, %s, %s, %s) ON CONFLICT DO NOTHING;'
+def iter_projects(f, chunk_size=URA_STREAM_CHUNK_SIZE):
+    """Yields one project (with its transactions) at a time from a downloaded batch
+
+    Args:
+        f (file): binary file holding a PMI_Resi_Transaction response body
+        chunk_size (int): bytes read from f per iteration
+    """
+    yield from iter_json_array(iter(lambda: f.read(chunk_size), b''), 'Result')
+
+
+def get_ingestion_state():
+    """Reads the content hash of every loaded URA batch and the latest
+       contract_date loaded for every project
+
+    Returns:
+        [tuple]: dict of batch -> content hash, dict of (project, street) -> date
+    """
+    batch_query = 'SELECT batch, content_hash FROM ingestion_batches;'
+    watermark_query = 'SELECT project, street, contract_date FROM ingestion_watermarks;'
+    hashes = {}
+    watermarks = {}
+    try:
+        with cursor() as cur:
+            cur.execute(batch_query)
+            hashes = dict(cur.fetchall())
+            cur.execute(watermark_query)
+            watermarks = {(project, street): contract_date for project, street, contract_date in cur.fetchall()}
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+        record(errors=1)
+    return hashes, watermarks
+
+
+def save_batch_hash(batch, content_hash):
+    query = (
+        'INSERT INTO ingestion_batches (batch, content_hash, updated_at) '
+        'VALUES (%s, %s, now()) '
+        'ON CONFLICT (batch) DO UPDATE '
+        'SET content_hash = EXCLUDED.content_hash, updated_at = EXCLUDED.updated_at;'
     )
-    trans_query = (
-        'INSERT INTO private_residential_property_transactions ('
-        '    project, street, area, floor_range,'
-        '    no_of_units, contract_date, type_of_sale,'
-        '    price, property_type, district, type_of_area,'
-        '    tenure, psf, tenure_type'
-        ')'
-        'VALUES'
-        '    ('
-        '        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s'
-        '    ) ON CONFLICT DO NOTHING;'
+    try:
+        with cursor() as cur:
+            cur.execute(query, (batch, content_hash))
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+        record(errors=1)
+
+
+def months_before(date, months):
+    """First day of the month that is months before date"""
+    year, month = divmod(date.year * 12 + date.month - 1 - months, 12)
+    return datetime.date(year, month + 1, 1)
+
+
+def transform_transactions(data, watermarks=None, lookback_months=INGEST_WATERMARK_LOOKBACK_MONTHS):
+    """Flattens URA projects into project and transaction rows
+
+    Transactions are kept from lookback_months before a project's watermark,
+    so late reported transactions still load. Rows already loaded are
+    deduplicated by ON CONFLICT on load.
+
+    Args:
+        data (list): projects from the PMI_Resi_Transaction result
+        watermarks (dict): (project, street) -> latest loaded contract_date,
+            transactions older than the lookback window are dropped
+        lookback_months (int): months before the watermark still loaded
+
+    Returns:
+        [tuple]: list of project rows and list of transaction rows, ordered as
+            PROJECT_COLUMNS and TRANSACTION_COLUMNS
+    """
+    proj_rows = []
+    names = []
+    counts = []
+    transactions = []
+    watermarks = watermarks or {}
+    streets = map_distinct([project.get('street') for project in data], cached_convert_abbreviation)
+    for project, street in zip(data, streets):
+        project_name = project.get('project')
+        watermark = watermarks.get((project_name, street))
+        if watermark is None:
+            proj_rows.append((project_name, street, project.get('x'), project.get('y')))
+
+        project_transactions = project.get('transaction')
+        if project_transactions is None:
+            LOGGER.warning(f'No transactions found for {project}')
+            continue
+        if watermark is not None:
+            cutoff = months_before(watermark, lookback_months)
+            project_transactions = [
+                transaction for transaction in project_transactions
+                if cached_contract_date(transaction.get('contractDate')) >= cutoff]
+        names.append((project_name, street))
+        counts.append(len(project_transactions))
+        transactions.extend(project_transactions)
+    if not transactions:
+        return proj_rows, []
+
+    # Parse column by column, repeated dates, districts and tenures are parsed once
+    names = np.array(names, dtype=object)
+    project_idx = np.repeat(np.arange(len(counts)), counts)
+    area = np.floor(np.array([t.get('area') for t in transactions], dtype=np.float64) * 10.764).astype(np.int64)
+    price = np.array([t.get('price') for t in transactions], dtype=np.float64)
+    tenures = [t.get('tenure') for t in transactions]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        psf = np.where(area > 0, np.floor(price / area), 0).astype(np.int64).astype(object)
+    psf[area == 0] = None
+    columns = [
+        names[project_idx, 0],
+        names[project_idx, 1],
+        area.tolist(),
+        [t.get('floorRange') for t in transactions],
+        np.array([t.get('noOfUnits') for t in transactions]).astype(np.int64).tolist(),
+        map_distinct([t.get('contractDate') for t in transactions], cached_contract_date),
+        [t.get('typeOfSale') for t in transactions],
+        np.rint(price).astype(np.int64).tolist(),
+        [t.get('propertyType') for t in transactions],
+        map_distinct([t.get('district') for t in transactions], lambda district: 'D' + district),
+        [t.get('typeOfArea') for t in transactions],
+        tenures,
+        psf.tolist(),
+        map_distinct(tenures, cached_get_tenure_type),
+    ]
+    return proj_rows, list(zip(*columns))
+
+
+def copy_rows(cur, table, columns, rows, on_insert=None):
+    """Streams rows into table through a temp staging table and COPY FROM STDIN,
+       then merges them into table in a single INSERT ... ON CONFLICT DO NOTHING
+
+    Args:
+        cur (cursor): open psycopg2 cursor, the caller owns the transaction
+        table (str): target table name
+        columns (list): column names in the same order as each row
+        rows (list): list of tuples
+        on_insert (str): optional statement run in the same query over the
+            newly inserted rows, exposed as the CTE "inserted"
+
+    Returns:
+        [int]: number of rows inserted into table
+    """
+    staging = f'{table}_staging'
+    cols = ', '.join(columns)
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+
+    cur.execute(
+        f'CREATE TEMP TABLE {staging} ON COMMIT DROP AS '
+        f'SELECT {cols} FROM {table} WITH NO DATA;')
+    cur.copy_expert(f'COPY {staging} ({cols}) FROM STDIN WITH (FORMAT csv)', buf)
+    insert_query = (
+        f'INSERT INTO {table} ({cols}) '
+        f'SELECT {cols} FROM {staging} '
+        f'ON CONFLICT DO NOTHING')
+    if on_insert:
+        cur.execute(
+            f'WITH inserted AS ({insert_query} RETURNING *), '
+            f'derived AS ({on_insert}) '
+            f'SELECT count(*) FROM inserted;')
+        inserted = cur.fetchone()[0]
+    else:
+        cur.execute(insert_query + ';')
+        inserted = cur.rowcount
+    cur.execute(f'DROP TABLE {staging};')
+    return inserted
+
+
+def update_watermarks(cur, trans_rows):
+    """Advances the per project contract_date watermark to the latest loaded row
+
+    Args:
+        cur (cursor): open psycopg2 cursor, the caller owns the transaction
+        trans_rows (list): transaction rows ordered as TRANSACTION_COLUMNS
+    """
+    query = (
+        'INSERT INTO ingestion_watermarks (project, street, contract_date) '
+        'VALUES %s '
+        'ON CONFLICT (project, street) DO UPDATE '
+        'SET contract_date = GREATEST(ingestion_watermarks.contract_date, EXCLUDED.contract_date);'
     )
-    conn = None
+    latest = {}
+    for row in trans_rows:
+        key = (row[0], row[1])
+        if key not in latest or row[5] > latest[key]:
+            latest[key] = row[5]
+    values = [(project, street, contract_date) for (project, street), contract_date in latest.items()]
+    execute_values(cur, query, values, page_size=1000)
+
+
+def load_rows(proj_rows, trans_rows):
+    """Bulk loads transformed project and transaction rows with COPY
+
+    Args:
+        proj_rows (list): project rows ordered as PROJECT_COLUMNS
+        trans_rows (list): transaction rows ordered as TRANSACTION_COLUMNS
+
+    Returns:
+        [bool]: True if the rows were committed
+    """
+    loaded = False
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        LOGGER.info(f'Total projects in batch = {len(data)}')
-        trans_count = 0
-        for project in data:
-            street = convert_abbreviation(project.get('street'))
-            project_name = project.get('project')
-            x = project.get('x')
-            y = project.get('y')
-            cur.execute(proj_query, (project_name, street, x, y))
-
-            transactions = project.get('transaction')
-            if transactions is None:
-                LOGGER.warning(f'No transactions found for {project}')
-            else:
-                trans_count += len(transactions)
-                for transaction in transactions:
-                    area = math.floor(float(transaction.get('area')) * 10.764)
-                    floor_range = transaction.get('floorRange')
-                    no_of_units = int(transaction.get('noOfUnits'))
-                    contract_date = format_date(transaction.get('contractDate'))
-                    type_of_sale = transaction.get('typeOfSale')
-                    price = float(transaction.get('price'))
-                    property_type = transaction.get('propertyType')
-                    district = 'D' + transaction.get('district')
-                    type_of_area = transaction.get('typeOfArea')
-                    tenure = transaction.get('tenure')
-                    psf = math.floor(price / area)
-                    tenure_type = get_tenure_type(tenure)
-                    values = (project_name, street, area, floor_range, no_of_units, contract_date, type_of_sale, price, property_type, district, type_of_area, tenure, psf, tenure_type)
-                    cur.execute(trans_query, values)
-        LOGGER.info(f'Total transactions in batch = {trans_count}')
-        conn.commit()
+        start = time.perf_counter()
+        with cursor() as cur:
+            ensure_transaction_partitions(cur, {row[5].year for row in trans_rows})
+            proj_count = copy_rows(cur, 'private_residential_property_projects', PROJECT_COLUMNS, proj_rows)
+            trans_count = copy_rows(
+                cur, 'private_residential_property_transactions', TRANSACTION_COLUMNS, trans_rows,
+                on_insert=rollup_merge_sql('inserted'))
+            update_watermarks(cur, trans_rows)
+            if trans_count:
+                bump_data_generation(cur)
+        loaded = True
+
+        elapsed = time.perf_counter() - start
+        rate = (len(proj_rows) + len(trans_rows)) / elapsed if elapsed else 0
+        LOGGER.info(f'New projects = {proj_count}, new transactions = {trans_count}')
+        LOGGER.info(f'Loaded {len(trans_rows)} transactions in {elapsed:.2f}s ({rate:.0f} rows/sec)')
     except (pg.DatabaseError) as e:
         LOGGER.exception(e)
+    return loaded
+
+
+def fetch_batch(token, batch, rows_queue, state=None, chunk_size=INGEST_CHUNK_SIZE):
+    """Downloads one URA batch and puts transformed rows on rows_queue in chunks
+       of chunk_size projects, blocking while the queue is full. A batch whose
+       content hash matches the last loaded one is skipped.
+
+    Args:
+        token (str): URA daily token
+        batch (int): URA batch number
+        rows_queue (queue.Queue): bounded queue read by write_rows
+        state (tuple): batch hashes and watermarks from get_ingestion_state,
+            None loads every row
+        chunk_size (int): number of projects per queued chunk
+    """
+    LOGGER.info(f'Batch = {batch}')
+    hashes, watermarks = state or ({}, {})
+    with stage('download'):
+        f, content_hash = download_batch(URA_PROPERTY_URL, URA_ACCESS_KEY, token, batch=batch)
+        if f is None:
+            record(errors=1)
+            return
+    with f:
+        if hashes.get(batch) == content_hash:
+            LOGGER.info(f'Batch {batch} is unchanged since the last load, skipping')
+            return
+        count = 0
+        projects = iter_projects(f)
+        while True:
+            # Time decoding and transforming only, not waiting on the full queue
+            with stage('transform'):
+                chunk = list(islice(projects, chunk_size))
+                if not chunk:
+                    break
+                rows = transform_transactions(chunk, watermarks)
+                record(rows=len(rows[1]))
+            rows_queue.put(('rows', batch, rows))
+            count += len(chunk)
+    if count == 0:
+        LOGGER.warning(f'No projects found in batch {batch}')
+    LOGGER.info(f'Total projects in batch {batch} = {count}')
+    rows_queue.put(('done', batch, content_hash))
+
+
+def write_rows(rows_queue):
+    """Loads queued chunks until a None sentinel. A batch's content hash is
+       saved once all of its chunks have loaded, so a failed batch is retried
+       on the next run.
+
+    Args:
+        rows_queue (queue.Queue): bounded queue filled by fetch_batch
+    """
+    failed = set()
+    while True:
+        item = rows_queue.get()
+        if item is None:
+            break
+        kind, batch, payload = item
+        with stage('load'):
+            try:
+                if kind == 'rows':
+                    proj_rows, trans_rows = payload
+                    if load_rows(proj_rows, trans_rows):
+                        record(rows=len(trans_rows))
+                    else:
+                        failed.add(batch)
+                        record(errors=1)
+                elif batch in failed:
+                    LOGGER.warning(f'Batch {batch} did not load completely, not saving its hash')
+                else:
+                    save_batch_hash(batch, payload)
+            except Exception as e:
+                failed.add(batch)
+                record(errors=1)
+                LOGGER.exception(e)
+
+
+def run_pipeline(token, batches=URA_BATCHES, workers=URA_FETCH_WORKERS, queue_size=INGEST_QUEUE_SIZE, incremental=True):
+    """Downloads URA batches in parallel while a single writer thread loads
+       the transformed rows, the bounded queue provides backpressure
+
+    Args:
+        token (str): URA daily token
+        batches (iterable): URA batch numbers to fetch
+        workers (int): max concurrent batch downloads
+        queue_size (int): max transformed chunks held in memory
+        incremental (bool): skip unchanged batches and rows more than
+            INGEST_WATERMARK_LOOKBACK_MONTHS older than the per project
+            contract_date watermark
+    """
+    start = time.perf_counter()
+    with stage('ingestion_state'):
+        state = get_ingestion_state() if incremental else None
+    rows_queue = queue.Queue(maxsize=queue_size)
+    writer = threading.Thread(target=write_rows, args=(rows_queue,), daemon=True)
+    writer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch_batch, token, batch, rows_queue, state): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    record(errors=1)
+                    LOGGER.error(f'Batch {futures[future]} failed')
+                    LOGGER.exception(e)
     finally:
-        if conn:
-            cur.close()
-            conn.close()
+        rows_queue.put(None)
+        writer.join()
+    LOGGER.info(f'Ingested batches {list(batches)} in {time.perf_counter() - start:.2f}s')
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=LOG_LEVEL)
 
-    token = get_token(URA_TOKEN_URL, URA_ACCESS_KEY)
-    extract_postal_districts()
-    extract_mrt_coordinates()
-    for i in range(1, 5, 1):
-        LOGGER.info(f'Batch = {i}')
-        result = get_private_residential_transactions(URA_PROPERTY_URL, URA_ACCESS_KEY, token, batch=i)
-        extract_transactions(result)
-    LOGGER.info('Updating projects longitude and latitude')
-    update_project_coordinates()
-    LOGGER.info('Updating projects nearest mrt')
-    update_proj_mrt_coordinates()
+    with metrics.run():
+        with stage('token'):
+            token = get_token(URA_TOKEN_URL, URA_ACCESS_KEY)
+        with stage('postal_districts'):
+            extract_postal_districts()
+        with stage('mrt_stations'):
+            extract_mrt_coordinates()
+        run_pipeline(token)
+        LOGGER.info('Updating projects longitude and latitude')
+        with stage('geocoding'):
+            update_project_coordinates()
+        LOGGER.info('Updating projects nearest mrt')
+        with stage('mrt_matching'):
+            update_proj_mrt_coordinates()
+        LOGGER.info('Refreshing dimension catalog')
+        with stage('dimension_catalog'):
+            refresh_dimension_catalog()
+        LOGGER.info('Writing transactions snapshot')
+        with stage('snapshot'):
+            write_snapshot()
+    log_pool_stats()
@@ -0,0 +1,124 @@
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from postgres_utils import FILTER_DIMENSIONS
+
+LOGGER = logging.getLogger(__name__)
+
+MASK_CACHE_SIZE = 4
+
+
+class FilterEngine:
+    """Applies sidebar selections to a transactions frame with cached masks.
+
+    Each filter (the year range, the area range and every FILTER_DIMENSIONS
+    multiselect) owns one boolean mask, cached per selection. Changing one
+    widget rebuilds only that mask and ANDs it with the product of the other
+    masks, which is itself cached while the same widget keeps changing, e.g.
+    while a slider is dragged. Categorical columns are matched through their
+    integer codes with a lookup table instead of comparing strings.
+
+    One engine is meant to be shared by every session serving the same frame,
+    so caches are guarded by a lock.
+    """
+
+    def __init__(self, df, cache_size=MASK_CACHE_SIZE):
+        self.df = df
+        self.cache_size = cache_size
+        self._masks = {}
+        self._rest = None
+        self._lock = threading.Lock()
+        self._all = np.ones(len(df), dtype=bool)
+        self._codes = {}
+        for dim in FILTER_DIMENSIONS:
+            if dim in df.columns and isinstance(df[dim].dtype, pd.CategoricalDtype):
+                self._codes[dim] = (df[dim].cat.codes.to_numpy(), df[dim].cat.categories)
+        self._years = df['contract_year'].to_numpy() if 'contract_year' in df.columns else None
+        self._area = df['area'].to_numpy() if 'area' in df.columns else None
+
+    @staticmethod
+    def selection_keys(filters):
+        """Splits sidebar selections into one hashable key per filter"""
+        keys = {
+            'contract_year': (filters.get('start_year'), filters.get('end_year')),
+            'area': (filters.get('min_area'), filters.get('max_area')),
+        }
+        for dim in FILTER_DIMENSIONS:
+            values = filters.get(dim)
+            keys[dim] = None if values is None else frozenset(values)
+        return keys
+
+    def _build_mask(self, dim, key):
+        if dim == 'contract_year':
+            start, end = key
+            mask = self._all.copy()
+            if start is not None:
+                mask &= self._years >= int(start)
+            if end is not None:
+                mask &= self._years <= int(end)
+            return mask
+        if dim == 'area':
+            low, high = key
+            mask = self._all.copy()
+            if low is not None:
+                mask &= self._area >= low
+            if high is not None:
+                mask &= self._area <= high
+            return mask
+        if key is None:
+            return self._all
+        if dim in self._codes:
+            codes, categories = self._codes[dim]
+            # code -1 (null) maps to the extra trailing False entry
+            lookup = np.zeros(len(categories) + 1, dtype=bool)
+            lookup[:-1] = categories.isin(list(key))
+            return lookup[codes]
+        return self.df[dim].isin(list(key)).to_numpy()
+
+    def _get_mask(self, dim, key):
+        cache = self._masks.setdefault(dim, OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        mask = self._build_mask(dim, key)
+        cache[key] = mask
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return mask
+
+    def mask(self, filters):
+        """Boolean mask of the rows matching filters
+
+        Args:
+            filters (dict): sidebar selections, see build_transactions_filter
+
+        Returns:
+            [np.ndarray]: boolean array aligned with the frame rows
+        """
+        keys = self.selection_keys(filters)
+        with self._lock:
+            if self._rest is not None:
+                dim, rest_keys, rest_mask = self._rest
+                if all(keys[other] == rest_keys[other] for other in keys if other != dim):
+                    return rest_mask & self._get_mask(dim, keys[dim])
+                changed = [other for other in keys if other != dim and keys[other] != rest_keys[other]]
+                dim = changed[0] if len(changed) == 1 else dim
+            else:
+                dim = 'contract_year'
+
+            rest_mask = self._all
+            for other, key in keys.items():
+                if other != dim:
+                    rest_mask = rest_mask & self._get_mask(other, key)
+            self._rest = (dim, keys, rest_mask)
+            return rest_mask & self._get_mask(dim, keys[dim])
+
+    def apply(self, filters):
+        """Rows of the frame matching filters
+
+        Returns:
+            [pd.DataFrame]: matching rows with a fresh index
+        """
+        return self.df.take(np.flatnonzero(self.mask(filters))).reset_index(drop=True)
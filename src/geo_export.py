@@ -0,0 +1,162 @@
+import os
+import io
+import json
+import gzip
+import logging
+import argparse
+import datetime
+import decimal
+from dotenv import load_dotenv
+import psycopg2 as pg
+from postgres_utils import iter_records
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '20000'))
+EXPORT_BUFFER_SIZE = int(os.getenv('EXPORT_BUFFER_SIZE', str(1024 * 1024)))
+EXPORT_GZIP_LEVEL = int(os.getenv('EXPORT_GZIP_LEVEL', '6'))
+
+GEOJSON = 'geojson'
+NDJSON = 'ndjson'
+
+# Every layer query returns longitude and latitude first, the remaining columns become feature properties
+LAYERS = {
+    'mrt': (
+        'SELECT longitude::float8, latitude::float8, id, name, type '
+        'FROM mrt '
+        'ORDER BY id asc;'
+    ),
+    'projects': (
+        'SELECT prpp.longitude::float8, prpp.latitude::float8, prpp.project_id, prpp.project, prpp.street,'
+        '    prpp.mrt_id, prpp.mrt_name, prpp.mrt_dist::float8, t.transactions, t.first_contract_date::text,'
+        '    t.last_contract_date::text '
+        'FROM private_residential_property_projects prpp '
+        'LEFT JOIN ('
+        '    SELECT project_id, count(*) AS transactions,'
+        '        min(contract_date) AS first_contract_date, max(contract_date) AS last_contract_date'
+        '    FROM private_residential_property_transactions'
+        '    GROUP BY project_id'
+        ') t ON t.project_id = prpp.project_id '
+        'ORDER BY prpp.project_id;'
+    ),
+    'transactions': (
+        'SELECT prpp.longitude::float8, prpp.latitude::float8, prpt.project_id, prpt.project, prpt.street,'
+        '    prpt.area::float8, prpt.floor_range, prpt.no_of_units::float8, prpt.contract_date::text,'
+        '    prpt.type_of_sale, prpt.price::float8, prpt.property_type, prpt.district, prpt.type_of_area,'
+        '    prpt.tenure, prpt.psf::float8, prpt.tenure_type, prpp.mrt_id, prpp.mrt_name, prpp.mrt_dist::float8 '
+        'FROM private_residential_property_projects prpp '
+        'INNER JOIN private_residential_property_transactions prpt '
+        'ON prpp.project_id = prpt.project_id;'
+    ),
+    'district_aggregates': (
+        'SELECT pd.longitude::float8, pd.latitude::float8, a.district, a.contract_year, a.transactions,'
+        '    a.no_of_units, a.area, a.price, a.price / NULLIF(a.area, 0) AS psf_mean '
+        'FROM ('
+        '    SELECT district, contract_year, sum(transactions)::int8 AS transactions,'
+        '        sum(no_of_units)::float8 AS no_of_units, sum(area)::float8 AS area, sum(price)::float8 AS price'
+        '    FROM transactions_rollup'
+        '    GROUP BY district, contract_year'
+        ') a '
+        'LEFT JOIN postal_districts pd ON pd.name = a.district '
+        'ORDER BY a.district, a.contract_year;'
+    ),
+}
+
+
+def to_json_value(value):
+    """json.dumps fallback for the numeric and date types psycopg2 returns"""
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def iter_features(columns, records):
+    """Yields GeoJSON Point features from records starting with longitude and latitude,
+       features without coordinates get a null geometry
+    """
+    names = columns[2:]
+    for record in records:
+        longitude, latitude = record[0], record[1]
+        yield {
+            'type': 'Feature',
+            'geometry': None if longitude is None or latitude is None else {
+                'type': 'Point', 'coordinates': [longitude, latitude]},
+            'properties': dict(zip(names, record[2:])),
+        }
+
+
+def open_output(path, compress=False):
+    """Opens path for buffered binary writes, gzip compressed if compress is True"""
+    if compress:
+        return io.BufferedWriter(gzip.open(path, 'wb', compresslevel=EXPORT_GZIP_LEVEL), buffer_size=EXPORT_BUFFER_SIZE)
+    return open(path, 'wb', buffering=EXPORT_BUFFER_SIZE)
+
+
+def export_layer(layer, path, fmt=GEOJSON, compress=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Streams a layer from a server-side cursor to a GeoJSON FeatureCollection
+       or newline delimited GeoJSON features, holding at most chunk_size rows
+       in memory. The file is written next to path and renamed over it.
+
+    Args:
+        layer (str): one of LAYERS
+        path (str): output filepath
+        fmt (str): GEOJSON or NDJSON
+        compress (bool): gzip the output, by default if path ends with .gz
+        chunk_size (int): rows fetched per round trip
+
+    Returns:
+        [int]: features written, None on error
+    """
+    query = LAYERS[layer]
+    if compress is None:
+        compress = path.endswith('.gz')
+    encoder = json.JSONEncoder(ensure_ascii=False, default=to_json_value, separators=(',', ':'))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    count = None
+    try:
+        with open_output(tmp_path, compress) as f:
+            features = 0
+            if fmt == GEOJSON:
+                f.write(b'{"type":"FeatureCollection","features":[\n')
+            separator = b',\n' if fmt == GEOJSON else b'\n'
+            for columns, records in iter_records(query, chunk_size=chunk_size):
+                for feature in iter_features(columns, records):
+                    if features:
+                        f.write(separator)
+                    f.write(encoder.encode(feature).encode('utf-8'))
+                    features += 1
+            if fmt == GEOJSON:
+                f.write(b'\n]}\n')
+            elif features:
+                f.write(b'\n')
+        os.replace(tmp_path, path)
+        count = features
+        LOGGER.info(f'Exported {count} {layer} features to {path}')
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return count
+
+
+def export_mrt_to_geojson(path='./data/mrt/rail-station-point.geojson'):
+    """Writes the mrt table back to the geojson file extract_mrt_coordinates reads"""
+    return export_layer('mrt', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports map layers as GeoJSON or newline delimited GeoJSON')
+    parser.add_argument('layer', choices=sorted(LAYERS))
+    parser.add_argument('path', help='output filepath, gzip compressed if it ends with .gz')
+    parser.add_argument('--format', choices=[GEOJSON, NDJSON], default=GEOJSON)
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=LOG_LEVEL)
+
+    export_layer(args.layer, args.path, fmt=args.format, chunk_size=args.chunk_size)
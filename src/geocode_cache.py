@@ -0,0 +1,115 @@
+import os
+import re
+import logging
+import datetime
+from dotenv import load_dotenv
+import psycopg2 as pg
+from psycopg2.extras import Json, execute_values
+from db import cursor
+from metrics import record
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+GEOCODE_CACHE_TTL_DAYS = float(os.getenv('GEOCODE_CACHE_TTL_DAYS', '365'))
+GEOCODE_CACHE_NEGATIVE_TTL_DAYS = float(os.getenv('GEOCODE_CACHE_NEGATIVE_TTL_DAYS', '7'))
+
+STREET = 'street'
+
+
+def normalize_street(street):
+    """Upper cases and collapses whitespace so spelling variants share a cache entry"""
+    return re.sub(r'\s+', ' ', street).strip().upper()
+
+
+class GeocodeCache:
+    """Persistent cache of OneMap responses backed by the geocode_cache table.
+
+    Entries are loaded once, looked up in memory and written back in one bulk
+    upsert by flush(). Empty responses are cached as negative results with a
+    shorter TTL, failed requests (None) are never cached.
+    """
+
+    def __init__(self, ttl_days=GEOCODE_CACHE_TTL_DAYS, negative_ttl_days=GEOCODE_CACHE_NEGATIVE_TTL_DAYS):
+        self.ttl = datetime.timedelta(days=ttl_days)
+        self.negative_ttl = datetime.timedelta(days=negative_ttl_days)
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        query = 'SELECT kind, key, response, fetched_at FROM geocode_cache;'
+        try:
+            with cursor() as cur:
+                cur.execute(query)
+                for kind, key, response, fetched_at in cur.fetchall():
+                    self.entries[(kind, key)] = (response, fetched_at)
+        except (pg.Error) as e:
+            LOGGER.exception(e)
+            record(errors=1)
+        LOGGER.info(f'Loaded {len(self.entries)} geocode cache entries')
+
+    def _is_fresh(self, response, fetched_at):
+        ttl = self.ttl if response else self.negative_ttl
+        return datetime.datetime.now() - fetched_at < ttl
+
+    def lookup(self, kind, key):
+        """Returns (True, response) for a fresh entry, else (False, None)
+
+        Args:
+            kind (str): lookup kind, STREET for OneMap street searches
+            key (str): normalized lookup key
+        """
+        entry = self.entries.get((kind, key))
+        if entry is not None and self._is_fresh(*entry):
+            self.hits += 1
+            return True, entry[0]
+        self.misses += 1
+        return False, None
+
+    def put(self, kind, key, response):
+        """Stores a fetched response, failed requests (None) are not cached"""
+        if response is not None:
+            entry = (response, datetime.datetime.now())
+            self.entries[(kind, key)] = entry
+            self.pending[(kind, key)] = entry
+
+    def get(self, kind, key, fetch):
+        """Returns the cached response for (kind, key), calling fetch() on a miss
+
+        Args:
+            kind (str): lookup kind, STREET for OneMap street searches
+            key (str): normalized lookup key
+            fetch (callable): performs the OneMap request, returns None on failure
+        """
+        hit, response = self.lookup(kind, key)
+        if not hit:
+            response = fetch()
+            self.put(kind, key, response)
+        return response
+
+    def flush(self):
+        """Upserts entries fetched since the last flush"""
+        query = (
+            'INSERT INTO geocode_cache (kind, key, response, fetched_at) '
+            'VALUES %s '
+            'ON CONFLICT (kind, key) DO UPDATE '
+            'SET response = EXCLUDED.response, fetched_at = EXCLUDED.fetched_at;'
+        )
+        if not self.pending:
+            return
+        values = [(kind, key, Json(response), fetched_at) for (kind, key), (response, fetched_at) in self.pending.items()]
+        try:
+            with cursor() as cur:
+                execute_values(cur, query, values, page_size=1000)
+            self.pending = {}
+        except (pg.Error) as e:
+            LOGGER.exception(e)
+            record(errors=1)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        LOGGER.info(f'Geocode cache hits = {self.hits}, misses = {self.misses}, hit rate = {rate:.1%}')
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+METRICS_REPORT_PATH = os.getenv('METRICS_REPORT_PATH', './data/metrics/ingestion_report.json')
+METRICS_TEXTFILE_PATH = os.getenv('METRICS_TEXTFILE_PATH', './data/metrics/ura_ingestion.prom')
+
+COUNTERS = ['rows', 'http_bytes', 'db_round_trips', 'errors']
+UNATTRIBUTED = 'unattributed'
+
+
+class RunMetrics:
+    """Thread-safe per stage wall time and counters for one pipeline run.
+
+    A stage is entered with stage(), which times it and attributes every
+    counter recorded on the same thread to it until it exits. Worker threads
+    attribute their counters to the stage that spawned them with bind().
+    Stages running on several threads at once sum their wall time over the
+    threads, so it can exceed the run's wall time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.started_at = datetime.datetime.now()
+            self.start = time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _entry(self, name):
+        return self.stages.setdefault(name, dict({'seconds': 0.0, 'calls': 0}, **{counter: 0 for counter in COUNTERS}))
+
+    def current_stage(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def bind(self, name):
+        """Attributes counters recorded on this thread to stage name, without timing"""
+        stack = self._stack()
+        stack.append(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as stage name"""
+        start = time.perf_counter()
+        try:
+            with self.bind(name):
+                yield
+        finally:
+            with self._lock:
+                entry = self._entry(name)
+                entry['seconds'] += time.perf_counter() - start
+                entry['calls'] += 1
+
+    def record(self, stage=None, **counts):
+        """Adds counts (any of COUNTERS) to stage, by default the current stage of this thread"""
+        name = stage or self.current_stage() or UNATTRIBUTED
+        with self._lock:
+            entry = self._entry(name)
+            for counter, count in counts.items():
+                entry[counter] += count
+
+    def report(self):
+        """Run report with rows/sec per stage
+
+        Returns:
+            [dict]: started_at, wall_seconds, errors and stages
+        """
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+            wall_seconds = time.perf_counter() - self.start
+        for entry in stages.values():
+            entry['rows_per_sec'] = entry['rows'] / entry['seconds'] if entry['seconds'] else 0.0
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'wall_seconds': wall_seconds,
+            'errors': sum(entry['errors'] for entry in stages.values()),
+            'stages': stages,
+        }
+
+
+_metrics = RunMetrics()
+
+
+def get_metrics():
+    """Returns the process wide RunMetrics"""
+    return _metrics
+
+
+def stage(name):
+    return _metrics.stage(name)
+
+
+def bind(name):
+    return _metrics.bind(name)
+
+
+def current_stage():
+    return _metrics.current_stage()
+
+
+def record(stage=None, **counts):
+    _metrics.record(stage, **counts)
+
+
+def write_atomic(path, content):
+    """Writes content next to path and renames it over path, so collectors never read a partial file"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def to_prometheus(report, job='ura_ingestion'):
+    """Formats a run report for the node_exporter textfile collector
+
+    Args:
+        report (dict): from RunMetrics.report
+        job (str): metric name prefix
+
+    Returns:
+        [str]: Prometheus text exposition format
+    """
+    finished_at = datetime.datetime.fromisoformat(report['started_at']).timestamp() + report['wall_seconds']
+    lines = []
+
+    def gauge(name, help_text, samples):
+        lines.append(f'# HELP {job}_{name} {help_text}')
+        lines.append(f'# TYPE {job}_{name} gauge')
+        for labels, value in samples:
+            label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels.items())
+            lines.append(f'{job}_{name}{{{label_text}}} {value}' if label_text else f'{job}_{name} {value}')
+
+    gauge('run_seconds', 'Wall time of the last run', [({}, report['wall_seconds'])])
+    gauge('run_errors', 'Errors in the last run', [({}, report['errors'])])
+    gauge('run_success', '1 if the last run had no errors', [({}, int(report['errors'] == 0))])
+    gauge('run_finished_timestamp_seconds', 'Unix time the last run finished', [({}, finished_at)])
+    stages = sorted(report['stages'].items())
+    for field, help_text in (
+            ('seconds', 'Wall time spent in the stage, summed over threads'),
+            ('rows', 'Rows processed by the stage'),
+            ('rows_per_sec', 'Rows processed per second of stage time'),
+            ('http_bytes', 'HTTP response bytes received by the stage'),
+            ('db_round_trips', 'Database round trips made by the stage'),
+            ('errors', 'Errors raised in the stage')):
+        gauge(f'stage_{field}', help_text, [({'stage': name}, entry[field]) for name, entry in stages])
+    return '\n'.join(lines) + '\n'
+
+
+def write_run_report(report_path=METRICS_REPORT_PATH, textfile_path=METRICS_TEXTFILE_PATH):
+    """Writes the run report as JSON and as a Prometheus textfile and logs a per stage summary
+
+    Returns:
+        [dict]: the run report
+    """
+    report = _metrics.report()
+    for name, entry in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+        LOGGER.info(
+            f"Stage {name}: {entry['seconds']:.2f}s, {entry['rows']} rows ({entry['rows_per_sec']:.0f} rows/sec), "
+            f"{entry['http_bytes'] / 2 ** 20:.1f}MB HTTP, {entry['db_round_trips']} DB round trips")
+    LOGGER.info(f"Run finished in {report['wall_seconds']:.2f}s with {report['errors']} errors")
+    try:
+        if report_path:
+            write_atomic(report_path, json.dumps(report, indent=2))
+        if textfile_path:
+            write_atomic(textfile_path, to_prometheus(report))
+    except OSError as e:
+        LOGGER.exception(e)
+    return report
+
+
+@contextmanager
+def run():
+    """Starts a fresh run and writes its report on exit, also when it fails.
+       Counters recorded outside any stage are attributed to 'run'.
+    """
+    _metrics.reset()
+    try:
+        with bind('run'):
+            yield _metrics
+    except Exception:
+        record(errors=1)
+        raise
+    finally:
+        write_run_report()
@@ -0,0 +1,83 @@
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371e3
+QUERY_CHUNK_SIZE = 4096
+
+
+class MrtIndex:
+    """Nearest neighbour lookups over mrt stations.
+
+    Stations are projected once to local equirectangular metres around their
+    mean latitude, which is accurate to well under 0.1% across Singapore, so
+    queries reduce to squared euclidean distances in NumPy. With a few hundred
+    stations a chunked dense scan is faster than walking a tree in Python and
+    answers batches of points in one pass.
+    """
+
+    def __init__(self, ids, names, longitudes, latitudes):
+        self.ids = np.asarray(ids, dtype=object)
+        self.names = np.asarray(names, dtype=object)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self._cos_lat0 = np.cos(np.radians(self.latitudes.mean())) if len(self) else 1.0
+        self._xy = self._project(self.longitudes, self.latitudes)
+        self._sq_norm = (self._xy ** 2).sum(axis=1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds the index from (id, name, longitude, latitude) rows, e.g. the mrt table
+
+        Args:
+            records (list): list of (id, name, longitude, latitude)
+        """
+        records = list(records)
+        if not records:
+            LOGGER.warning('No mrt records found, index is empty')
+            return cls([], [], [], [])
+        ids, names, longitudes, latitudes = zip(*records)
+        return cls(ids, names, [float(v) for v in longitudes], [float(v) for v in latitudes])
+
+    def _project(self, longitudes, latitudes):
+        x = EARTH_RADIUS * np.radians(longitudes) * self._cos_lat0
+        y = EARTH_RADIUS * np.radians(latitudes)
+        return np.column_stack([np.ravel(x), np.ravel(y)])
+
+    def _sq_dist(self, xy):
+        # |a - b|^2 = |a|^2 - 2ab + |b|^2, clipped for rounding error
+        sq = (xy ** 2).sum(axis=1)[:, np.newaxis] - 2 * xy @ self._xy.T + self._sq_norm
+        return np.maximum(sq, 0)
+
+    def nearest(self, longitude, latitude, k=1):
+        """Finds the k closest stations to one or many points
+
+        Args:
+            longitude (float or array-like): query longitude(s)
+            latitude (float or array-like): query latitude(s)
+            k (int): number of stations per point
+
+        Returns:
+            [tuple]: station indices and distances in metres sorted by distance,
+                shaped (k,) for a single point or (n, k) for arrays
+        """
+        scalar = np.ndim(longitude) == 0
+        xy = self._project(np.asarray(longitude, dtype=np.float64), np.asarray(latitude, dtype=np.float64))
+        k = min(k, len(self))
+        idx = np.empty((len(xy), k), dtype=np.int64)
+        dist = np.empty((len(xy), k), dtype=np.float64)
+        for start in range(0, len(xy), QUERY_CHUNK_SIZE):
+            end = start + QUERY_CHUNK_SIZE
+            sq = self._sq_dist(xy[start:end])
+            part = np.argpartition(sq, k - 1, axis=1)[:, :k] if k < len(self) else np.tile(np.arange(k), (len(sq), 1))
+            part_sq = np.take_along_axis(sq, part, axis=1)
+            order = np.argsort(part_sq, axis=1)
+            idx[start:end] = np.take_along_axis(part, order, axis=1)
+            dist[start:end] = np.sqrt(np.take_along_axis(part_sq, order, axis=1))
+        if scalar:
+            return idx[0], dist[0]
+        return idx, dist
@@ -1,26 +1,59 @@
 import os
 import json
+import uuid
 import logging
+import datetime
 from dotenv import load_dotenv
 import psycopg2 as pg
+from psycopg2.extras import execute_values
+from db import connection, cursor
+from metrics import record
+import numpy as np
 import pandas as pd
-from utils import get_coordinates_distance
+import pyarrow as pa
+from mrt_index import MrtIndex
+from utils import compact_frame, memory_report
+from query_log import read_sql, fetch_all
 
 LOGGER = logging.getLogger(__name__)
 
 load_dotenv()
-POSTGRES_DB = os.getenv('POSTGRES_DB', 'postgres')
-POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
-POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
-
-params = {
-    'host': POSTGRES_HOST,
-    'port': POSTGRES_PORT,
-    'user': POSTGRES_USER,
-    'password': POSTGRES_PASSWORD,
-    'dbname': POSTGRES_DB
+READ_CHUNK_SIZE = int(os.getenv('READ_CHUNK_SIZE', '50000'))
+
+DIMENSIONS = ['contract_year', 'type_of_area', 'property_type', 'tenure_type', 'type_of_sale', 'floor_range']
+FILTER_DIMENSIONS = ['type_of_sale', 'type_of_area', 'property_type', 'tenure_type', 'floor_range']
+ROLLUP_DIMENSIONS = ['district', 'type_of_sale', 'type_of_area', 'property_type', 'tenure_type', 'floor_range']
+AGGREGATE_COLUMNS = {
+    'district': 'prpt.district',
+    'mrt_name': 'prpp.mrt_name',
+    'contract_year': 'EXTRACT(YEAR FROM prpt.contract_date)::int',
+}
+# Prices reach tens of millions and stay float64, float32 would round them to whole dollars
+TRANSACTION_DTYPES = {
+    'project': 'category',
+    'street': 'category',
+    'area': 'float32',
+    'floor_range': 'category',
+    'no_of_units': 'float32',
+    'contract_date': 'datetime64[ns]',
+    'type_of_sale': 'category',
+    'price': 'float64',
+    'property_type': 'category',
+    'district': 'category',
+    'type_of_area': 'category',
+    'tenure': 'category',
+    'psf': 'float32',
+    'tenure_type': 'category',
+    'project_id': 'int32',
+    'contract_year': 'int16',
+    'mrt_id': 'category',
+    'mrt_name': 'category',
+    'mrt_dist': 'float32',
+}
+ROLLUP_AGGREGATE_COLUMNS = {
+    'district': 'r.district',
+    'mrt_name': "NULLIF(r.mrt_name, '')",
+    'contract_year': 'r.contract_year',
 }
 
 
@@ -30,17 +63,12 @@ def get_mrt_data():
         'FROM mrt '
         'ORDER BY id asc;'
     )
-    conn = None
     df = None
     try:
-        conn = pg.connect(**params)
-        df = pd.read_sql(query, con=conn)
+        df = read_sql('get_mrt_data', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            conn.close()
-        return df
+    return df
 
 
 def get_postal_districts_data():
@@ -48,17 +76,25 @@ def get_postal_districts_data():
         'SELECT name as district, latitude, longitude '
         'FROM postal_districts;'
     )
-    conn = None
     df = None
     try:
-        conn = pg.connect(**params)
-        df = pd.read_sql(query, con=conn)
+        df = read_sql('get_postal_districts_data', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            conn.close()
-        return df
+    return df
+
+
+def compact_transactions(df):
+    """Converts a transactions frame to TRANSACTION_DTYPES and logs the memory saved"""
+    if df is None:
+        return None
+    compact = compact_frame(df, TRANSACTION_DTYPES)
+    report = memory_report(df, compact)
+    LOGGER.debug(f'Transactions frame memory by column:\n{report}')
+    LOGGER.info(
+        f"Compacted {len(df)} transactions from {report.at['total', 'bytes_before'] / 2 ** 20:.1f}MB "
+        f"to {report.at['total', 'bytes_after'] / 2 ** 20:.1f}MB")
+    return compact
 
 
 def get_transactions_data():
@@ -66,17 +102,12 @@ def get_transactions_data():
         'SELECT *, EXTRACT(YEAR FROM contract_date)  as contract_year '
         'FROM private_residential_property_transactions;'
     )
-    conn = None
     df = None
     try:
-        conn = pg.connect(**params)
-        df = pd.read_sql(query, con=conn)
+        df = read_sql('get_transactions_data', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            conn.close()
-        return df
+    return compact_transactions(df)
 
 
 def get_transactions_mrt_data():
@@ -84,145 +115,520 @@ def get_transactions_mrt_data():
         'SELECT prpt.*, EXTRACT(YEAR FROM contract_date) as contract_year, mrt_id, mrt_name, mrt_dist '
         'FROM private_residential_property_projects prpp '
         'INNER JOIN private_residential_property_transactions prpt '
-        'ON prpp.project = prpt.project AND prpp.street = prpt.street;'
+        'ON prpp.project_id = prpt.project_id;'
+    )
+    df = None
+    try:
+        df = read_sql('get_transactions_mrt_data', query)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    return compact_transactions(df)
+
+
+def iter_records(query, args=None, chunk_size=READ_CHUNK_SIZE, conn=None):
+    """Yields the result of query in chunks from a server-side cursor, so only
+       chunk_size rows are held client side at a time. Without conn a pooled
+       connection is checked out until the generator is exhausted or closed.
+
+    Args:
+        query (str): SQL to run
+        args (list): query parameters
+        chunk_size (int): rows fetched per round trip
+        conn (connection): optional open connection, e.g. to read inside its transaction
+
+    Yields:
+        [tuple]: (column names, list of up to chunk_size records)
+    """
+    if conn is None:
+        with connection() as conn:
+            try:
+                yield from iter_records(query, args, chunk_size, conn)
+            except GeneratorExit:
+                conn.rollback()
+                raise
+        return
+    with conn.cursor(name=f'chunked_{uuid.uuid4().hex}') as cur:
+        cur.itersize = chunk_size
+        cur.execute(query, args)
+        while True:
+            records = cur.fetchmany(chunk_size)
+            if not records:
+                break
+            yield [column.name for column in cur.description], records
+
+
+def iter_frames(query, args=None, chunk_size=READ_CHUNK_SIZE, dtypes=None):
+    """Yields the result of query as DataFrames of up to chunk_size rows, see iter_records
+
+    Args:
+        dtypes (dict): column -> dtype applied to every chunk with compact_frame.
+            Category columns get per chunk categories, concatenated chunks fall back to object.
+    """
+    for columns, records in iter_records(query, args, chunk_size):
+        df = pd.DataFrame.from_records(records, columns=columns, coerce_float=True)
+        yield compact_frame(df, dtypes) if dtypes else df
+
+
+def iter_record_batches(query, args=None, chunk_size=READ_CHUNK_SIZE, schema=None, conn=None):
+    """Yields the result of query as Arrow record batches of up to chunk_size rows, see iter_records
+
+    Args:
+        schema (pa.Schema): schema matching the query columns in order, inferred per batch if None
+    """
+    for columns, records in iter_records(query, args, chunk_size, conn):
+        arrays = list(zip(*records))
+        if schema is None:
+            yield pa.RecordBatch.from_arrays([pa.array(array) for array in arrays], names=columns)
+        else:
+            yield pa.record_batch(
+                [pa.array(array, type=field.type) for array, field in zip(arrays, schema)], schema=schema)
+
+
+def iter_transactions_data(chunk_size=READ_CHUNK_SIZE):
+    """Chunked get_transactions_data, yields compact DataFrames of up to chunk_size rows"""
+    query = (
+        'SELECT *, EXTRACT(YEAR FROM contract_date) as contract_year '
+        'FROM private_residential_property_transactions;'
+    )
+    yield from iter_frames(query, chunk_size=chunk_size, dtypes=TRANSACTION_DTYPES)
+
+
+def iter_transactions_mrt_data(chunk_size=READ_CHUNK_SIZE):
+    """Chunked get_transactions_mrt_data, yields compact DataFrames of up to chunk_size rows"""
+    query = (
+        'SELECT prpt.*, EXTRACT(YEAR FROM contract_date) as contract_year, mrt_id, mrt_name, mrt_dist '
+        'FROM private_residential_property_projects prpp '
+        'INNER JOIN private_residential_property_transactions prpt '
+        'ON prpp.project_id = prpt.project_id;'
+    )
+    yield from iter_frames(query, chunk_size=chunk_size, dtypes=TRANSACTION_DTYPES)
+
+
+def build_transactions_filter(filters):
+    """Turns sidebar selections into a parameterized WHERE clause on
+       private_residential_property_transactions aliased prpt. Years become a
+       contract_date range so an index on contract_date can be used.
+
+    Args:
+        filters (dict): any of start_year, end_year, min_area, max_area and a
+            list of values for each of FILTER_DIMENSIONS, missing keys are not filtered
+
+    Returns:
+        [tuple]: (where clause, list of query parameters)
+    """
+    clauses = []
+    args = []
+    if filters.get('start_year') is not None:
+        clauses.append('prpt.contract_date >= %s')
+        args.append(datetime.date(int(filters['start_year']), 1, 1))
+    if filters.get('end_year') is not None:
+        clauses.append('prpt.contract_date < %s')
+        args.append(datetime.date(int(filters['end_year']) + 1, 1, 1))
+    if filters.get('min_area') is not None:
+        clauses.append('prpt.area >= %s')
+        args.append(filters['min_area'])
+    if filters.get('max_area') is not None:
+        clauses.append('prpt.area <= %s')
+        args.append(filters['max_area'])
+    for dim in FILTER_DIMENSIONS:
+        if filters.get(dim) is not None:
+            clauses.append(f'prpt.{dim} = ANY(%s)')
+            args.append(list(filters[dim]))
+    return ' AND '.join(clauses) or 'TRUE', args
+
+
+def build_filtered_transactions_query(filters):
+    """Query and parameters behind get_filtered_transactions_mrt_data"""
+    where, args = build_transactions_filter(filters)
+    query = (
+        'SELECT prpt.*, EXTRACT(YEAR FROM prpt.contract_date)::int as contract_year, mrt_id, mrt_name, mrt_dist '
+        'FROM private_residential_property_projects prpp '
+        'INNER JOIN private_residential_property_transactions prpt '
+        'ON prpp.project_id = prpt.project_id '
+        f'WHERE {where};'
+    )
+    return query, args
+
+
+def get_filtered_transactions_mrt_data(filters):
+    """Same rows as get_transactions_mrt_data restricted to the sidebar selections"""
+    query, args = build_filtered_transactions_query(filters)
+    df = None
+    try:
+        df = read_sql('get_filtered_transactions_mrt_data', query, args)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    return compact_transactions(df)
+
+
+def build_filtered_aggregates_query(filters, by):
+    """Query and parameters behind get_filtered_aggregates"""
+    where, args = build_transactions_filter(filters)
+    group_cols = ', '.join(f'{AGGREGATE_COLUMNS[col]} AS {col}' for col in by)
+    query = (
+        f'SELECT {group_cols}, '
+        '    sum(prpt.no_of_units)::float8 AS no_of_units,'
+        '    sum(prpt.area)::float8 AS area,'
+        '    sum(prpt.price)::float8 AS price '
+        'FROM private_residential_property_projects prpp '
+        'INNER JOIN private_residential_property_transactions prpt '
+        'ON prpp.project_id = prpt.project_id '
+        f'WHERE {where} '
+        f"GROUP BY {', '.join(str(i + 1) for i in range(len(by)))} "
+        f"ORDER BY {', '.join(str(i + 1) for i in range(len(by)))};"
+    )
+    return query, args
+
+
+def get_filtered_aggregates(filters, by):
+    """Sums units, area and price of the selected transactions grouped by columns
+
+    Args:
+        filters (dict): sidebar selections, see build_transactions_filter
+        by (list): columns from AGGREGATE_COLUMNS to group by
+
+    Returns:
+        [pd.DataFrame]: no_of_units, area and price sums indexed by by
+    """
+    query, args = build_filtered_aggregates_query(filters, by)
+    df = None
+    try:
+        df = read_sql('get_filtered_aggregates', query, args, index_col=list(by))
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    return df
+
+
+def explain_queries(cur, queries):
+    """Runs EXPLAIN ANALYZE on each query
+
+    Args:
+        cur (cursor): open psycopg2 cursor
+        queries (dict): name -> (query, args)
+
+    Returns:
+        [dict]: name -> execution time in ms and the scan nodes of the plan
+    """
+    report = {}
+    for name, (query, args) in queries.items():
+        cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, args)
+        plan = cur.fetchone()[0][0]
+        scans = []
+        nodes = [plan['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if 'Relation Name' in node:
+                scans.append(f"{node['Node Type']} on {node['Relation Name']}")
+            nodes.extend(node.get('Plans', []))
+        report[name] = {'execution_ms': round(plan['Execution Time'], 1), 'scans': sorted(scans)}
+    return report
+
+
+def get_app_queries(filters):
+    """The transactions queries the app issues for one set of sidebar selections"""
+    return {
+        'filtered_transactions': build_filtered_transactions_query(filters),
+        'aggregates_by_district': build_filtered_aggregates_query(filters, ('district',)),
+        'aggregates_by_mrt_year': build_filtered_aggregates_query(filters, ('mrt_name', 'contract_year')),
+    }
+
+
+def ensure_transaction_partitions(cur, years):
+    """Creates the missing yearly partitions of the transactions table, each
+       with the project_id trigger as Postgres 12 cannot define BEFORE ROW
+       triggers on the partitioned parent. Does nothing until the table has
+       been partitioned by migrate.py.
+
+    Args:
+        cur (cursor): open psycopg2 cursor
+        years (iterable): contract years that must have a partition
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('private_residential_property_transactions');")
+    row = cur.fetchone()
+    if row is None or row[0] != 'p':
+        return
+    for year in sorted(set(years)):
+        partition = f'private_residential_property_transactions_y{year}'
+        cur.execute('SELECT to_regclass(%s);', (partition,))
+        if cur.fetchone()[0] is not None:
+            continue
+        cur.execute(
+            f'CREATE TABLE public.{partition} PARTITION OF public.private_residential_property_transactions '
+            'FOR VALUES FROM (%s) TO (%s);',
+            (datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)))
+        cur.execute(
+            f'CREATE TRIGGER {partition}_project_id '
+            f'BEFORE INSERT OR UPDATE OF project, street ON public.{partition} '
+            'FOR EACH ROW EXECUTE FUNCTION set_transaction_project_id();')
+        LOGGER.info(f'Created transactions partition for {year}')
+
+
+def rollup_merge_sql(source, sign=None, mrt_columns=None):
+    """SQL adding the transactions in source into transactions_rollup.
+
+    Cells are keyed by the nearest mrt of the transaction's project rather
+    than by project, so the projects around one station share their cells.
+    mrt_name is kept next to mrt_id so aggregates never join the projects
+    table. Area is not part of the key, selections with area bounds inside
+    the data's area range are answered from the raw transactions.
+
+    Args:
+        source (str): table or CTE name with the transactions table columns
+        sign (str): optional column of source holding 1 or -1, rows with -1
+            are subtracted from their cell
+        mrt_columns (tuple): optional columns of source holding each row's
+            mrt_id and mrt_name, by default looked up in the projects table
+    """
+    dims = ', '.join(f"COALESCE(s.{dim}, '')" for dim in ROLLUP_DIMENSIONS)
+    if sign:
+        measures = f'sum(s.{sign}), COALESCE(sum(s.{sign} * s.no_of_units), 0), sum(s.{sign} * s.area), sum(s.{sign} * s.price)'
+    else:
+        measures = 'count(*), COALESCE(sum(s.no_of_units), 0), sum(s.area), sum(s.price)'
+    if mrt_columns:
+        mrt_id, mrt_name = (f's.{column}' for column in mrt_columns)
+        join = ''
+    else:
+        mrt_id, mrt_name = 'prpp.mrt_id', 'prpp.mrt_name'
+        join = 'LEFT JOIN private_residential_property_projects prpp ON prpp.project_id = s.project_id '
+    return (
+        'INSERT INTO transactions_rollup ('
+        f"    mrt_id, mrt_name, contract_year, {', '.join(ROLLUP_DIMENSIONS)},"
+        '    transactions, no_of_units, area, price'
+        ') '
+        f"SELECT COALESCE({mrt_id}, ''), COALESCE({mrt_name}, ''), EXTRACT(YEAR FROM s.contract_date)::int, {dims},"
+        f'    {measures} '
+        f'FROM {source} s '
+        f'{join}'
+        'GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9 '
+        'ON CONFLICT ON CONSTRAINT transactions_rollup_pk DO UPDATE SET '
+        '    transactions = transactions_rollup.transactions + EXCLUDED.transactions,'
+        '    no_of_units = transactions_rollup.no_of_units + EXCLUDED.no_of_units,'
+        '    area = transactions_rollup.area + EXCLUDED.area,'
+        '    price = transactions_rollup.price + EXCLUDED.price'
     )
-    conn = None
+
+
+def bump_data_generation(cur):
+    """Marks the transactions/mrt join as changed. Writers call it in the same
+       transaction as their change, so the data version moves exactly when
+       the new rows become visible, also for rewrites that keep every count
+    """
+    cur.execute('UPDATE data_generation SET generation = generation + 1, updated_at = now();')
+
+
+def get_area_range():
+    """Smallest and largest transaction area, read from the area index
+
+    Returns:
+        [tuple]: (min area, max area), both None without transactions
+    """
+    query = 'SELECT min(area)::float8, max(area)::float8 FROM private_residential_property_transactions;'
+    return fetch_all('get_area_range', query)[0]
+
+
+def build_rollup_filter(filters, area_range=None):
+    """Turns sidebar selections into a WHERE clause on transactions_rollup aliased r
+
+    Args:
+        filters (dict): sidebar selections, see build_transactions_filter
+        area_range (tuple): (min area, max area) of the transactions, needed
+            when filters has area bounds
+
+    Returns:
+        [tuple]: (where clause, list of query parameters), or None when the area
+            bounds exclude some transactions and raw rows are needed
+    """
+    min_area = filters.get('min_area')
+    max_area = filters.get('max_area')
+    if min_area is not None or max_area is not None:
+        if area_range is None:
+            return None
+        low, high = area_range
+        if low is not None and ((min_area is not None and min_area > low) or (max_area is not None and max_area < high)):
+            return None
+
+    clauses = []
+    args = []
+    if filters.get('start_year') is not None:
+        clauses.append('r.contract_year >= %s')
+        args.append(int(filters['start_year']))
+    if filters.get('end_year') is not None:
+        clauses.append('r.contract_year <= %s')
+        args.append(int(filters['end_year']))
+    for dim in FILTER_DIMENSIONS:
+        if filters.get(dim) is not None:
+            clauses.append(f'r.{dim} = ANY(%s)')
+            args.append(list(filters[dim]))
+    return ' AND '.join(clauses) or 'TRUE', args
+
+
+def get_rollup_aggregates(filters, by):
+    """Same result as get_filtered_aggregates summed from transactions_rollup cells
+
+    Returns:
+        [pd.DataFrame]: no_of_units, area and price sums indexed by by, or None
+            when the selection cannot be answered from the rollup
+    """
     df = None
     try:
-        conn = pg.connect(**params)
-        df = pd.read_sql(query, con=conn)
+        area_range = None
+        if filters.get('min_area') is not None or filters.get('max_area') is not None:
+            area_range = get_area_range()
+        rollup_filter = build_rollup_filter(filters, area_range)
+        if rollup_filter is None:
+            return None
+        where, args = rollup_filter
+        group_cols = ', '.join(f'{ROLLUP_AGGREGATE_COLUMNS[col]} AS {col}' for col in by)
+        query = (
+            f'SELECT {group_cols}, '
+            '    sum(r.no_of_units)::float8 AS no_of_units,'
+            '    sum(r.area)::float8 AS area,'
+            '    sum(r.price)::float8 AS price '
+            'FROM transactions_rollup r '
+            f'WHERE {where} '
+            f"GROUP BY {', '.join(str(i + 1) for i in range(len(by)))} "
+            f"ORDER BY {', '.join(str(i + 1) for i in range(len(by)))};"
+        )
+        df = read_sql('get_rollup_aggregates', query, args, index_col=list(by))
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            conn.close()
-        return df
+    return df
+
+
+def get_aggregates(filters, by):
+    """Aggregates from the rollup when possible, else from the raw transactions"""
+    df = get_rollup_aggregates(filters, by)
+    if df is None:
+        df = get_filtered_aggregates(filters, by)
+    return df
 
 
 def get_contract_date_years():
     query = ('SELECT DISTINCT EXTRACT(YEAR FROM contract_date) as year FROM private_residential_property_transactions order by year asc')
-    conn = None
-    records = None
+    records = []
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        records = fetch_all('get_contract_date_years', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [int(element) for tupl in records for element in tupl]
+    return [int(element) for tupl in records for element in tupl]
 
 
 def get_mrt_name_labels():
     query = ('SELECT DISTINCT name FROM mrt order by name asc')
-    conn = None
-    records = None
+    records = []
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        records = fetch_all('get_mrt_name_labels', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [element for tupl in records for element in tupl]
+    return [element for tupl in records for element in tupl]
 
 
 def get_area_type_labels():
     query = ('SELECT DISTINCT type_of_area FROM private_residential_property_transactions order by type_of_area asc')
-    conn = None
-    records = None
+    records = []
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        records = fetch_all('get_area_type_labels', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [element for tupl in records for element in tupl]
+    return [element for tupl in records for element in tupl]
 
 
 def get_property_type_labels():
     query = ('SELECT DISTINCT property_type FROM private_residential_property_transactions order by property_type asc')
-    conn = None
-    records = None
+    records = []
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        records = fetch_all('get_property_type_labels', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [element for tupl in records for element in tupl]
+    return [element for tupl in records for element in tupl]
 
 
 def get_sale_type_labels():
     query = ('SELECT DISTINCT type_of_sale FROM private_residential_property_transactions order by type_of_sale asc')
-    conn = None
-    records = None
+    records = []
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        records = fetch_all('get_sale_type_labels', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [element for tupl in records for element in tupl]
+    return [element for tupl in records for element in tupl]
 
 
 def get_floor_range_labels():
     query = ('SELECT DISTINCT floor_range FROM private_residential_property_transactions order by floor_range asc')
-    conn = None
-    records = None
+    records = []
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        records = fetch_all('get_floor_range_labels', query)
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [element for tupl in records for element in tupl]
+    return [element for tupl in records for element in tupl]
 
 
 def get_tenure_type_labels():
     query = ('SELECT DISTINCT tenure_type FROM private_residential_property_transactions order by tenure_type asc')
-    conn = None
-    records = None
+    records = []
+    try:
+        records = fetch_all('get_tenure_type_labels', query)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    return [element for tupl in records for element in tupl]
+
+
+def refresh_dimension_catalog():
+    """Rebuilds dimension_catalog, every sidebar filter value with its row count,
+       in a single GROUPING SETS scan of the transactions table. Run after ingestion.
+    """
+    grouping = ' '.join(f"WHEN GROUPING({dim}) = 0 THEN '{dim}'" for dim in DIMENSIONS + ['mrt_name'])
+    insert_query = (
+        'INSERT INTO dimension_catalog (dimension, value, row_count, updated_at) '
+        'SELECT dimension, value, row_count, now() FROM ('
+        f'    SELECT CASE {grouping} END AS dimension,'
+        f"        COALESCE({', '.join(DIMENSIONS + ['mrt_name'])}) AS value,"
+        '        count(*) AS row_count'
+        '    FROM ('
+        '        SELECT EXTRACT(YEAR FROM prpt.contract_date)::int::varchar AS contract_year,'
+        '            prpt.type_of_area, prpt.property_type, prpt.tenure_type,'
+        '            prpt.type_of_sale, prpt.floor_range, prpp.mrt_name'
+        '        FROM private_residential_property_transactions prpt'
+        '        LEFT JOIN private_residential_property_projects prpp'
+        '        ON prpp.project_id = prpt.project_id'
+        '    ) t'
+        f"    GROUP BY GROUPING SETS ({', '.join(f'({dim})' for dim in DIMENSIONS + ['mrt_name'])})"
+        ') d '
+        'WHERE value IS NOT NULL;'
+    )
+    mrt_query = (
+        'INSERT INTO dimension_catalog (dimension, value, row_count, updated_at) '
+        "SELECT DISTINCT 'mrt_name', name, 0, now() FROM mrt "
+        'ON CONFLICT DO NOTHING;'
+    )
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        with cursor() as cur:
+            cur.execute('DELETE FROM dimension_catalog;')
+            cur.execute(insert_query)
+            cur.execute(mrt_query)
+        LOGGER.info('Refreshed dimension catalog')
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return [element for tupl in records for element in tupl]
+        record(errors=1)
+
+
+def get_dimension_catalog():
+    """Reads every sidebar filter value in one query
+
+    Returns:
+        [dict]: dimension -> sorted list of values, contract_year values are int
+    """
+    query = 'SELECT dimension, value FROM dimension_catalog ORDER BY dimension, value;'
+    records = []
+    try:
+        records = fetch_all('get_dimension_catalog', query)
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    catalog = {dim: [] for dim in DIMENSIONS + ['mrt_name']}
+    for dimension, value in records:
+        catalog.setdefault(dimension, []).append(value)
+    catalog['contract_year'] = sorted(int(year) for year in catalog['contract_year'])
+    return catalog
 
 
 def extract_postal_districts(path='./data/ura-postal-districts/ura-postal-districts-point.geojson'):
@@ -240,27 +646,20 @@ def extract_postal_districts(path='./data/ura-postal-districts/ura-postal-distri
         '        %s, %s, %s, %s, %s'
         '    ) ON CONFLICT DO NOTHING;'
         )
-    conn = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-
-        with open(path) as f:
-            features = json.load(f).get('features')
-            for feature in features:
-                name = 'D' + feature['properties']['name']
-                longitude = feature['geometry']['coordinates'][0]
-                latitude = feature['geometry']['coordinates'][1]
-                postal = feature['properties']['postal-sector']
-                location = feature['properties']['location']
-                cur.execute(query, (name, latitude, longitude, postal, location))
-            conn.commit()
+        with cursor() as cur:
+            with open(path) as f:
+                features = json.load(f).get('features')
+                for feature in features:
+                    name = 'D' + feature['properties']['name']
+                    longitude = feature['geometry']['coordinates'][0]
+                    latitude = feature['geometry']['coordinates'][1]
+                    postal = feature['properties']['postal-sector']
+                    location = feature['properties']['location']
+                    cur.execute(query, (name, latitude, longitude, postal, location))
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+        record(errors=1)
 
 
 def extract_mrt_coordinates(path='./data/mrt/rail-station-point.geojson'):
@@ -278,117 +677,95 @@ def extract_mrt_coordinates(path='./data/mrt/rail-station-point.geojson'):
         '        %s, %s, %s, %s, %s'
         '    ) ON CONFLICT DO NOTHING;'
         )
-    conn = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-
-        with open(path) as f:
-            features = json.load(f).get('features')
-            for feature in features:
-                mrt_id = feature['properties']['id']
-                mrt_name = feature['properties']['name']
-                mrt_type = feature['properties']['type']
-                geo_type = feature['geometry']['type']
-                if geo_type == 'Point':
-                    longitude = feature['geometry']['coordinates'][0]
-                    latitude = feature['geometry']['coordinates'][1]
-                else:
-                    longitude = feature['geometry']['coordinates'][0][0]
-                    latitude = feature['geometry']['coordinates'][0][1]
-                cur.execute(query, (mrt_id, mrt_name, mrt_type, longitude, latitude))
-            conn.commit()
+        with cursor() as cur:
+            with open(path) as f:
+                features = json.load(f).get('features')
+                for feature in features:
+                    mrt_id = feature['properties']['id']
+                    mrt_name = feature['properties']['name']
+                    mrt_type = feature['properties']['type']
+                    geo_type = feature['geometry']['type']
+                    if geo_type == 'Point':
+                        longitude = feature['geometry']['coordinates'][0]
+                        latitude = feature['geometry']['coordinates'][1]
+                    else:
+                        longitude = feature['geometry']['coordinates'][0][0]
+                        latitude = feature['geometry']['coordinates'][0][1]
+                    cur.execute(query, (mrt_id, mrt_name, mrt_type, longitude, latitude))
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+        record(errors=1)
+
 
+def update_proj_mrt_coordinates(refresh=False):
+    """Assigns the closest mrt station to projects with coordinates. The
+       transactions_rollup cells of every project whose mrt changes are moved
+       to the new mrt in the same statement.
 
-def update_proj_mrt_coordinates():
+    Args:
+        refresh (bool): recompute every project instead of only those without
+            an mrt, e.g. after new stations open
+    """
     proj_query = (
-        'SELECT project, street, longitude, latitude, mrt_id, mrt_name, mrt_dist '
-        'FROM private_residential_property_projects;'
+        'SELECT project_id, longitude, latitude '
+        'FROM private_residential_property_projects '
+        'WHERE longitude IS NOT NULL AND latitude IS NOT NULL'
         )
+    if not refresh:
+        proj_query += ' AND (mrt_id IS NULL OR mrt_name IS NULL)'
     mrt_query = (
         'SELECT id, name, longitude, latitude '
         'FROM mrt;'
     )
-    insert_query = (
-        'UPDATE private_residential_property_projects '
-        'SET mrt_id = %s, mrt_name = %s, mrt_dist = %s '
-        'WHERE project = %s AND street = %s'
+    update_query = (
+        'WITH v (project_id, mrt_id, mrt_name, mrt_dist) AS (VALUES %s), '
+        'changed AS ('
+        '    SELECT prpp.project_id, prpp.mrt_id AS old_mrt_id, prpp.mrt_name AS old_mrt_name,'
+        '        v.mrt_id AS new_mrt_id, v.mrt_name AS new_mrt_name'
+        '    FROM private_residential_property_projects prpp'
+        '    INNER JOIN v ON v.project_id = prpp.project_id'
+        '    WHERE prpp.mrt_id IS DISTINCT FROM v.mrt_id OR prpp.mrt_name IS DISTINCT FROM v.mrt_name'
+        '), deltas AS ('
+        f"    SELECT {', '.join(f'prpt.{column}' for column in ['contract_date', 'no_of_units', 'area', 'price'] + ROLLUP_DIMENSIONS)},"
+        '        d.mrt_id, d.mrt_name, d.sign'
+        '    FROM changed c'
+        '    INNER JOIN private_residential_property_transactions prpt ON prpt.project_id = c.project_id'
+        '    CROSS JOIN LATERAL (VALUES (c.old_mrt_id, c.old_mrt_name, -1), (c.new_mrt_id, c.new_mrt_name, 1))'
+        '        AS d (mrt_id, mrt_name, sign)'
+        '), updated AS ('
+        '    UPDATE private_residential_property_projects prpp '
+        '    SET mrt_id = v.mrt_id, mrt_name = v.mrt_name, mrt_dist = v.mrt_dist '
+        '    FROM v '
+        '    WHERE prpp.project_id = v.project_id '
+        '    RETURNING 1'
+        f"), merged AS ({rollup_merge_sql('deltas', sign='sign', mrt_columns=('mrt_id', 'mrt_name'))}) "
+        'SELECT count(*) FROM updated;'
     )
-    conn = None
+    cleanup_query = 'DELETE FROM transactions_rollup WHERE transactions = 0;'
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(proj_query)
-        proj_records = cur.fetchall()
-        cur.execute(mrt_query)
-        mrt_records = cur.fetchall()
-        if not proj_records:
-            LOGGER.warning('No project records found, check private_residential_property_projects DB table')
-        if not mrt_records:
-            LOGGER.warning('No mrt records found, check mrt DB table')
-
-        for proj in proj_records:
-            proj_name = proj[0]
-            proj_street = proj[1]
-            proj_long = proj[2]
-            proj_lat = proj[3]
-            if proj_long and proj_lat:
-                mrt_id = proj[4]
-                mrt_name = proj[5]
-                proj_coord = (float(proj_long), float(proj_lat))
-
-                if None in (mrt_id, mrt_name):
-                    closest_mrt_id = None
-                    closest_mrt_name = None
-                    closest_mrt_dist = 9999999
-                    for mrt in mrt_records:
-                        mrt_long = float(mrt[2])
-                        mrt_lat = float(mrt[3])
-                        mrt_coord = (mrt_long, mrt_lat)
-                        dist = get_coordinates_distance(proj_coord, mrt_coord)
-                        if dist < closest_mrt_dist:
-                            closest_mrt_id = mrt[0]
-                            closest_mrt_name = mrt[1]
-                            closest_mrt_dist = dist
-                    LOGGER.debug(proj[0], closest_mrt_id, closest_mrt_name, closest_mrt_dist)
-                    cur.execute(insert_query, (closest_mrt_id, closest_mrt_name, closest_mrt_dist, proj_name, proj_street))
-        conn.commit()
+        with cursor() as cur:
+            cur.execute(proj_query)
+            proj_records = cur.fetchall()
+            cur.execute(mrt_query)
+            mrt_records = cur.fetchall()
+            if not proj_records:
+                LOGGER.warning('No project records to update, check private_residential_property_projects DB table')
+            if not mrt_records:
+                LOGGER.warning('No mrt records found, check mrt DB table')
+
+            if proj_records and mrt_records:
+                index = MrtIndex.from_records(mrt_records)
+                proj_coords = np.array([(proj[1], proj[2]) for proj in proj_records], dtype=np.float64)
+                idx, dist = index.nearest(proj_coords[:, 0], proj_coords[:, 1])
+                values = [
+                    (proj[0], index.ids[i], index.names[i], float(d))
+                    for proj, i, d in zip(proj_records, idx[:, 0], dist[:, 0])]
+                execute_values(cur, update_query, values, page_size=len(values))
+                cur.execute(cleanup_query)
+                bump_data_generation(cur)
+                record(rows=len(values))
+                LOGGER.info(f'Updated nearest mrt for {len(values)} projects')
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-
-
-def export_mrt_to_geojson(path='./data/mrt/rail-station-point.geojson'):
-    df = get_mrt_data()
-
-    with open(path, 'w+') as f:
-        f.write('{\n')
-        f.write('    "type": "FeatureCollection",\n')
-        f.write('    "features": [\n')
-        for index, row in df.iterrows():
-            f.write('        {\n')
-            f.write('            "type": "Feature",\n')
-            f.write('            "geometry": {\n')
-            f.write('                "type": "Point",\n')
-            f.write('                "coordinates": [%s, %s]\n' % (row['longitude'], row['latitude']))
-            f.write('            },\n')
-            f.write('            "properties": {\n')
-            f.write('                "id": "%s",\n' % (row['id']))
-            f.write('                "name": "%s",\n' % (row['name']))
-            f.write('                "type": "%s"\n' % (row['type']))
-            f.write('           }\n')
-            if (index == len(df) - 1):
-                f.write('        }\n')
-            else:
-                f.write('        },\n')
-        f.write('    ]\n')
-        f.write('}\n')
+        record(errors=1)
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import threading
+from dotenv import load_dotenv
+import psycopg2 as pg
+import pandas as pd
+from db import connection, cursor
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '500'))
+SLOW_QUERY_LOG_PATH = os.getenv('SLOW_QUERY_LOG_PATH', './data/logs/slow_queries.jsonl')
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', 'false').lower() in ('1', 'true', 'yes')
+
+BYTES_SAMPLE_ROWS = 1000
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def get_session_id():
+    """Id of the Streamlit session running the current script, None outside the app.
+       Streamlit is only looked up if the process already imported it.
+    """
+    if 'streamlit' not in sys.modules:
+        return None
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        try:
+            from streamlit.script_run_context import get_script_run_ctx
+        except ImportError:
+            try:
+                from streamlit.report_thread import get_report_ctx as get_script_run_ctx
+            except ImportError:
+                return None
+    ctx = get_script_run_ctx()
+    return getattr(ctx, 'session_id', None)
+
+
+def approx_bytes(result):
+    """Estimates the size of a query result from its first BYTES_SAMPLE_ROWS rows
+
+    Args:
+        result (DataFrame or list): query result, a frame or fetched records
+
+    Returns:
+        [int]: approximate bytes
+    """
+    if result is None or len(result) == 0:
+        return 0
+    sample = result[:BYTES_SAMPLE_ROWS]
+    if isinstance(result, pd.DataFrame):
+        sample_bytes = sample.memory_usage(index=False, deep=True).sum()
+    else:
+        sample_bytes = sum(len(str(value)) for record in sample for value in record)
+    return int(sample_bytes * len(result) / len(sample))
+
+
+def explain(query, args=None):
+    """EXPLAIN plan of query without running it
+
+    Returns:
+        [dict]: plan in JSON format, None on error
+    """
+    plan = None
+    try:
+        with cursor() as cur:
+            cur.execute('EXPLAIN (FORMAT JSON) ' + query, args)
+            plan = cur.fetchone()[0][0]
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    return plan
+
+
+def log_query(name, query, args, seconds, result):
+    """Records one query and appends it to the slow query log when it took
+       at least SLOW_QUERY_MS, with its plan if SLOW_QUERY_EXPLAIN is set
+
+    Args:
+        name (str): reader name, e.g. get_transactions_mrt_data
+        query (str): SQL sent
+        args (list): query parameters
+        seconds (float): wall time including fetching the result
+        result (DataFrame or list): query result
+    """
+    duration_ms = seconds * 1000
+    rows = 0 if result is None else len(result)
+    nbytes = approx_bytes(result)
+    session = get_session_id()
+    with _lock:
+        stats = _stats.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'bytes': 0, 'slow': 0})
+        stats['calls'] += 1
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+        stats['rows'] += rows
+        stats['bytes'] += nbytes
+        stats['slow'] += duration_ms >= SLOW_QUERY_MS
+    LOGGER.debug(f'Query {name} session={session}: {duration_ms:.1f}ms, {rows} rows, ~{nbytes / 2 ** 20:.2f}MB')
+    if duration_ms < SLOW_QUERY_MS:
+        return
+
+    LOGGER.warning(f'Slow query {name} session={session}: {duration_ms:.1f}ms, {rows} rows, ~{nbytes / 2 ** 20:.2f}MB')
+    entry = {
+        'logged_at': datetime.datetime.now().isoformat(timespec='milliseconds'),
+        'name': name,
+        'session': session,
+        'duration_ms': round(duration_ms, 1),
+        'rows': rows,
+        'bytes': nbytes,
+        'query': query,
+        'args': args,
+    }
+    if SLOW_QUERY_EXPLAIN:
+        entry['plan'] = explain(query, args)
+    if not SLOW_QUERY_LOG_PATH:
+        return
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(SLOW_QUERY_LOG_PATH)), exist_ok=True)
+        with _lock, open(SLOW_QUERY_LOG_PATH, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+    except OSError as e:
+        LOGGER.exception(e)
+
+
+def read_sql(name, query, params=None, **kwargs):
+    """pd.read_sql on a pooled connection, recorded with log_query
+
+    Args:
+        name (str): reader name used in the query stats and slow query log
+        query (str): SQL to run
+        params (list): query parameters
+        **kwargs: passed on to pd.read_sql, e.g. index_col
+
+    Returns:
+        [pd.DataFrame]: query result
+    """
+    start = time.perf_counter()
+    with connection() as conn:
+        df = pd.read_sql(query, con=conn, params=params, **kwargs)
+    log_query(name, query, params, time.perf_counter() - start, df)
+    return df
+
+
+def fetch_all(name, query, args=None):
+    """cursor.fetchall on a pooled connection, recorded with log_query
+
+    Returns:
+        [list]: fetched records
+    """
+    start = time.perf_counter()
+    with cursor() as cur:
+        cur.execute(query, args)
+        records = cur.fetchall()
+    log_query(name, query, args, time.perf_counter() - start, records)
+    return records
+
+
+def get_query_stats():
+    """Calls, total and max ms, rows, bytes and slow calls per reader since the process started"""
+    with _lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
+
+
+def log_query_stats():
+    for name, stats in sorted(get_query_stats().items(), key=lambda item: -item[1]['total_ms']):
+        LOGGER.info(
+            f"Query {name}: {stats['calls']} calls, {stats['total_ms']:.0f}ms total, {stats['max_ms']:.0f}ms max, "
+            f"{stats['rows']} rows, ~{stats['bytes'] / 2 ** 20:.1f}MB, {stats['slow']} slow")
@@ -0,0 +1,187 @@
+import os
+import json
+import logging
+import datetime
+from dotenv import load_dotenv
+import psycopg2 as pg
+import pyarrow as pa
+from db import connection, cursor
+from metrics import record
+from postgres_utils import compact_transactions, iter_record_batches
+
+LOGGER = logging.getLogger(__name__)
+
+load_dotenv()
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', './data/snapshot/transactions_mrt.arrow')
+SNAPSHOT_CHUNK_SIZE = int(os.getenv('SNAPSHOT_CHUNK_SIZE', '50000'))
+
+# Same columns and order as get_filtered_transactions_mrt_data, rows from SNAPSHOT_QUERY
+SNAPSHOT_SCHEMA = pa.schema([
+    ('project', pa.string()),
+    ('street', pa.string()),
+    ('area', pa.float64()),
+    ('floor_range', pa.string()),
+    ('no_of_units', pa.float64()),
+    ('contract_date', pa.date32()),
+    ('type_of_sale', pa.string()),
+    ('price', pa.float64()),
+    ('property_type', pa.string()),
+    ('district', pa.string()),
+    ('type_of_area', pa.string()),
+    ('tenure', pa.string()),
+    ('psf', pa.float64()),
+    ('tenure_type', pa.string()),
+    ('project_id', pa.int32()),
+    ('contract_year', pa.int32()),
+    ('mrt_id', pa.string()),
+    ('mrt_name', pa.string()),
+    ('mrt_dist', pa.float64()),
+])
+
+SNAPSHOT_QUERY = (
+    'SELECT prpt.project, prpt.street, prpt.area::float8, prpt.floor_range, prpt.no_of_units::float8,'
+    '    prpt.contract_date, prpt.type_of_sale, prpt.price::float8, prpt.property_type, prpt.district,'
+    '    prpt.type_of_area, prpt.tenure, prpt.psf::float8, prpt.tenure_type, prpt.project_id,'
+    '    EXTRACT(YEAR FROM prpt.contract_date)::int, prpp.mrt_id, prpp.mrt_name, prpp.mrt_dist::float8 '
+    'FROM private_residential_property_projects prpp '
+    'INNER JOIN private_residential_property_transactions prpt '
+    'ON prpp.project_id = prpt.project_id;'
+)
+
+DATA_VERSION_QUERY = (
+    "SELECT md5(concat_ws('|',"
+    '    (SELECT generation FROM data_generation),'
+    "    (SELECT count(*) || ':' || count(tenure_type) FROM private_residential_property_transactions),"
+    "    (SELECT string_agg(batch || ':' || content_hash, ',' ORDER BY batch) FROM ingestion_batches),"
+    "    (SELECT string_agg(concat_ws(',', project, street, mrt_id), ';' ORDER BY project, street)"
+    '     FROM private_residential_property_projects)'
+    '));'
+)
+
+
+def get_data_version(cur=None):
+    """Fingerprint of the transactions/mrt join: the data_generation every
+       writer bumps, so in-place rewrites such as a tenure type reclassify
+       change it too, plus transaction and tenure type counts, loaded URA
+       batch hashes and every project's mrt assignment for changes made
+       outside the pipeline
+
+    Args:
+        cur (cursor): optional open cursor, e.g. to read it in the same snapshot as the data
+
+    Returns:
+        [str]: md5 hex digest, None on error
+    """
+    if cur is not None:
+        cur.execute(DATA_VERSION_QUERY)
+        return cur.fetchone()[0]
+    version = None
+    try:
+        with cursor() as cur:
+            cur.execute(DATA_VERSION_QUERY)
+            version = cur.fetchone()[0]
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+    return version
+
+
+def iter_snapshot_batches(chunk_size=SNAPSHOT_CHUNK_SIZE, conn=None, schema=SNAPSHOT_SCHEMA):
+    """Streams the transactions/mrt join as SNAPSHOT_SCHEMA record batches of up to chunk_size rows,
+       e.g. for offline analytics over the full history with bounded memory
+
+    Args:
+        chunk_size (int): rows per record batch
+        conn (connection): optional open connection, see iter_records
+        schema (pa.Schema): SNAPSHOT_SCHEMA, optionally with metadata
+    """
+    yield from iter_record_batches(SNAPSHOT_QUERY, chunk_size=chunk_size, schema=schema, conn=conn)
+
+
+def write_snapshot(path=SNAPSHOT_PATH, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """Writes the transactions/mrt join to an Arrow IPC file tagged with its data version.
+
+    Rows are streamed from a server-side cursor in chunk_size record batches
+    inside one repeatable read transaction, so the version always matches the
+    rows. The file is written next to path and renamed over it, readers that
+    still have the previous file memory mapped keep a consistent view.
+
+    Args:
+        path (str): snapshot filepath
+        chunk_size (int): rows per record batch
+
+    Returns:
+        [str]: data version written, None on error
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    version = None
+    rows = 0
+    try:
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+                version = get_data_version(cur)
+            metadata = {
+                'version': version,
+                'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            }
+            schema = SNAPSHOT_SCHEMA.with_metadata({'snapshot': json.dumps(metadata)})
+            with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+                for batch in iter_snapshot_batches(chunk_size, conn=conn, schema=schema):
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+        os.replace(tmp_path, path)
+        record(rows=rows)
+        LOGGER.info(f'Wrote snapshot version {version} with {rows} rows to {path}')
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+        record(errors=1)
+        version = None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return version
+
+
+def read_snapshot_metadata(path=SNAPSHOT_PATH):
+    """Reads only the snapshot footer
+
+    Returns:
+        [dict]: version and created_at, None if there is no snapshot
+    """
+    if not os.path.exists(path):
+        return None
+    with pa.memory_map(path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return json.loads(metadata.get(b'snapshot', b'{}'))
+
+
+def load_snapshot(version=None, path=SNAPSHOT_PATH):
+    """Loads the snapshot from a memory map, Arrow buffers are read in place
+       and converted to the compact TRANSACTION_DTYPES frame with string
+       columns decoded directly to categoricals.
+
+    Args:
+        version (str): expected data version, a snapshot with any other version is stale
+        path (str): snapshot filepath
+
+    Returns:
+        [tuple]: (DataFrame, version), or (None, None) if missing or stale
+    """
+    metadata = read_snapshot_metadata(path)
+    if metadata is None:
+        LOGGER.info(f'No snapshot found at {path}')
+        return None, None
+    if version is not None and metadata.get('version') != version:
+        LOGGER.info(f"Snapshot version {metadata.get('version')} is stale, data version is {version}")
+        return None, None
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    if table.schema.names != SNAPSHOT_SCHEMA.names:
+        LOGGER.info(f"Snapshot version {metadata.get('version')} has outdated columns, ignoring it")
+        return None, None
+    # Strings are dictionary encoded by Arrow straight into categoricals, no Python
+    # string objects are built, compact_transactions then only narrows the numbers
+    df = compact_transactions(table.to_pandas(split_blocks=True, strings_to_categorical=True))
+    LOGGER.info(f"Loaded snapshot version {metadata.get('version')} created at {metadata.get('created_at')}")
+    return df, metadata.get('version')
@@ -1,9 +1,19 @@
 import os
+import time
+import datetime
 import logging
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import psycopg2 as pg
-from utils import get_tenure_type
+from psycopg2.extras import execute_values
+from db import cursor
+import metrics
+from postgres_utils import bump_data_generation, rollup_merge_sql
+import numpy as np
+from utils import svy21_to_wgs84
+from geocode_cache import GeocodeCache, STREET, normalize_street
 
 LOGGER = logging.getLogger(__name__)
 
@@ -11,31 +21,26 @@ load_dotenv()
 URA_ACCESS_KEY = os.getenv('URA_ACCESS_KEY')
 URA_TOKEN_URL = os.getenv('URA_TOKEN_URL', 'https://www.ura.gov.sg/uraDataService/insertNewToken.action')
 URA_PROPERTY_URL = os.getenv('URA_PROPERTY_URL', 'https://www.ura.gov.sg/uraDataService/invokeUraDS')
-ONEMAP_COORD_URL = os.getenv('ONEMAP_COORD_URL', 'https://developers.onemap.sg/commonapi/convert/3414to4326')
 ONEMAP_SEARCH_URL = os.getenv('ONEMAP_SEARCH_URL', 'https://developers.onemap.sg/commonapi/search')
-POSTGRES_DB = os.getenv('POSTGRES_DB', 'postgres')
-POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
-POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
-
-params = {
-    'host': POSTGRES_HOST,
-    'port': POSTGRES_PORT,
-    'user': POSTGRES_USER,
-    'password': POSTGRES_PASSWORD,
-    'dbname': POSTGRES_DB
-}
-
-
-def get_xy_coordinates(x=20276.794, y=31255.976):
-    payload = {'X': x, 'Y': y}
-    r = requests.get(
-        url=ONEMAP_COORD_URL,
-        params=payload)
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    return None
+ONEMAP_RATE_LIMIT = float(os.getenv('ONEMAP_RATE_LIMIT', '4'))
+ONEMAP_MAX_IN_FLIGHT = int(os.getenv('ONEMAP_MAX_IN_FLIGHT', '4'))
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at least 1 / rate seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
 
 
 def get_street_coordinates(street='ORCHARD BOULEVARD'):
@@ -43,140 +48,208 @@ def get_street_coordinates(street='ORCHARD BOULEVARD'):
     r = requests.get(
         url=ONEMAP_SEARCH_URL,
         params=payload)
+    metrics.record(http_bytes=len(r.content))
     if r.status_code == requests.codes.ok:
         return r.json().get('results')
     return None
 
 
-def get_transactions_table():
-    query = (
-        'SELECT project, street, area, floor_range, contract_date, type_of_sale, price, tenure, tenure_type '
-        'FROM private_residential_property_transactions'
-        )
-    conn = None
-    records = None
-    try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
-    except (pg.Error) as e:
-        LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return records
-
-
 def get_projects_table():
     query = ('SELECT * FROM private_residential_property_projects')
-    conn = None
     records = None
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query)
-        records = cur.fetchall()
+        with cursor() as cur:
+            cur.execute(query)
+            records = cur.fetchall()
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-        return records
+        metrics.record(errors=1)
+    return records
+
+
+def to_floats(*values):
+    """Converts OneMap strings and DB numerics alike so VALUES rows share one type"""
+    return tuple(None if v in (None, '') else float(v) for v in values)
+
+
+def fetch_concurrently(lookups, rate=ONEMAP_RATE_LIMIT, max_in_flight=ONEMAP_MAX_IN_FLIGHT):
+    """Runs OneMap requests on a thread pool, limited to rate requests per second
+       and max_in_flight concurrent requests
+
+    Args:
+        lookups (dict): key -> zero argument callable performing the request
+        rate (float): max requests started per second
+        max_in_flight (int): max concurrent requests
+
+    Returns:
+        [dict]: key -> response, None for failed requests
+    """
+    limiter = RateLimiter(rate)
+    caller_stage = metrics.current_stage()
+
+    def fetch(item):
+        key, request = item
+        limiter.wait()
+        with metrics.bind(caller_stage):
+            try:
+                return key, request()
+            except requests.RequestException as e:
+                LOGGER.warning(f'OneMap request failed - {key}: {e}')
+                metrics.record(errors=1)
+                return key, None
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        return dict(executor.map(fetch, lookups.items()))
 
 
 def update_project_coordinates():
+    """Fills XY, longitude and latitude for projects missing them.
+
+    Projects without XY are geocoded by street through OneMap, lookups are
+    deduplicated, served from the geocode cache where possible and the rest
+    fetched concurrently. Projects with XY are converted from SVY21 locally in
+    one array operation. Every project is then updated in one bulk UPDATE and
+    no DB connection is held open while waiting on the network.
+    """
     projects = get_projects_table()
-    query1 = (
-        'UPDATE private_residential_property_projects '
-        'SET x = %s, y = %s, latitude = %s, longitude = %s '
-        'WHERE project = %s AND street = %s AND x IS NULL AND y IS NULL;'
-        )
-    query2 = (
-        'UPDATE private_residential_property_projects '
-        'SET latitude = %s, longitude = %s '
-        'WHERE project = %s AND street = %s AND x = %s AND y = %s;'
+    query = (
+        'UPDATE private_residential_property_projects prpp '
+        'SET x = v.x::numeric, y = v.y::numeric, latitude = v.latitude::numeric, longitude = v.longitude::numeric '
+        'FROM (VALUES %s) AS v (project, street, x, y, latitude, longitude) '
+        'WHERE prpp.project = v.project AND prpp.street = v.street;'
         )
     if not projects:
         LOGGER.warning('No project records found, check private_residential_property_projects DB table')
-    else:
-        conn = None
-        try:
-            conn = pg.connect(**params)
-            cur = conn.cursor()
-            for record in projects:
-                project = record[0]
-                street = record[1]
-                x = record[2]
-                y = record[3]
-                latitude = record[4]
-                longitude = record[5]
-
-                if (None in [x, y]) or ('' in [x, y]):
-                    LOGGER.debug(f'No XY found - {record}')
-                    street_coord = get_street_coordinates(street)
-                    if street_coord:
-                        x = street_coord[0].get('X')
-                        y = street_coord[0].get('Y')
-                        latitude = street_coord[0].get('LATITUDE')
-                        longitude = street_coord[0].get('LONGITUDE')
-                        cur.execute(query1, (x, y, latitude, longitude, project, street))
-                    else: 
-                        LOGGER.warning(f'OneMap street search returned empty list - {street}')
-
-                if (None in [latitude, longitude]) or ('' in [latitude, longitude]):
-                    LOGGER.debug(f'No long lat found - {record}')
-                    wgs84_coord = get_xy_coordinates(x, y)
-                    if wgs84_coord:
-                        latitude = wgs84_coord.get('latitude')
-                        longitude = wgs84_coord.get('longitude')
-                        cur.execute(query2, (latitude, longitude, project, street, x, y))
-                    else:
-                        LOGGER.warning(f'OneMap coordinates search returned empty list - {(x, y)}')
-            conn.commit()
-        except (pg.Error) as e:
-            LOGGER.exception(e)
-        finally:
-            if conn:
-                cur.close()
-                conn.close()        
-
-
-def update_transactions_tenure():
-    transactions = get_transactions_table()
+        return
+
+    cache = GeocodeCache()
+    lookups = {}
+    responses = {}
+    for record in projects:
+        street = record[1]
+        x = record[2]
+        y = record[3]
+        if (None in [x, y]) or ('' in [x, y]):
+            key = (STREET, normalize_street(street))
+            if key not in responses and key not in lookups:
+                hit, responses[key] = cache.lookup(*key)
+                if not hit:
+                    lookups[key] = lambda street=street: get_street_coordinates(street)
+
+    LOGGER.info(f'Fetching {len(lookups)} OneMap lookups')
+    for key, response in fetch_concurrently(lookups).items():
+        responses[key] = response
+        cache.put(*key, response)
+    cache.flush()
+    cache.log_stats()
+
+    values = []
+    xy_records = [
+        record for record in projects
+        if not ((None in record[2:4]) or ('' in record[2:4]))
+        and ((None in record[4:6]) or ('' in record[4:6]))]
+    if xy_records:
+        xy = np.array([to_floats(record[2], record[3]) for record in xy_records], dtype=np.float64)
+        latitudes, longitudes = svy21_to_wgs84(xy[:, 0], xy[:, 1])
+        for record, latitude, longitude in zip(xy_records, latitudes, longitudes):
+            values.append((record[0], record[1]) + to_floats(record[2], record[3], latitude, longitude))
+
+    for record in projects:
+        project, street, x, y = record[:4]
+        if (None in [x, y]) or ('' in [x, y]):
+            street_coord = responses[(STREET, normalize_street(street))]
+            if not street_coord:
+                LOGGER.warning(f'OneMap street search returned empty list - {street}')
+                continue
+            values.append((project, street) + to_floats(
+                street_coord[0].get('X'), street_coord[0].get('Y'),
+                street_coord[0].get('LATITUDE'), street_coord[0].get('LONGITUDE')))
+
+    if not values:
+        return
+    try:
+        with cursor() as cur:
+            execute_values(cur, query, values, page_size=len(values))
+        metrics.record(rows=len(values))
+        LOGGER.info(f'Updated coordinates for {len(values)} projects')
+    except (pg.Error) as e:
+        LOGGER.exception(e)
+        metrics.record(errors=1)
+
+
+# Mirrors utils.get_tenure_type so the backfill runs inside Postgres
+TENURE_TYPE_SQL = (
+    'CASE'
+    "    WHEN split_part(tenure, ' ', 1) ~ '^[+-]?[0-9]+$' THEN CASE"
+    "        WHEN split_part(tenure, ' ', 1)::numeric = 60 THEN '60 years'"
+    "        WHEN split_part(tenure, ' ', 1)::numeric > 60 AND split_part(tenure, ' ', 1)::numeric <= 110 THEN '99 years'"
+    "        WHEN split_part(tenure, ' ', 1)::numeric > 110 THEN '999 years'"
+    "        ELSE 'Unknown' END"
+    "    WHEN split_part(tenure, ' ', 1) = 'Freehold' THEN 'Freehold'"
+    "    ELSE 'Unknown' "
+    'END'
+)
+
+
+def update_transactions_tenure(reclassify=False):
+    """Fills tenure_type with set based UPDATEs, one contract year per
+       transaction. The transactions_rollup cells of every changed row are
+       moved in the same statement so the rollup stays consistent.
+
+    Args:
+        reclassify (bool): recompute every row, e.g. after changing the
+            bucketing, instead of only rows without a tenure type
+
+    Returns:
+        [int]: number of transactions updated
+    """
+    years_query = (
+        'SELECT EXTRACT(YEAR FROM min(contract_date))::int, EXTRACT(YEAR FROM max(contract_date))::int '
+        'FROM private_residential_property_transactions;'
+    )
+    condition = f'tenure_type IS DISTINCT FROM {TENURE_TYPE_SQL}' if reclassify else 'tenure_type IS NULL'
+    keys = 'project, street, area, floor_range, contract_date, type_of_sale, price'
+    columns = f'{keys}, no_of_units, property_type, district, type_of_area, project_id'
     query = (
-        'UPDATE private_residential_property_transactions '
-        'SET tenure_type = %s '
-        'WHERE project = %s AND street = %s AND area = %s AND floor_range = %s '
-        '   AND contract_date = %s AND type_of_sale = %s AND price = %s'
+        'WITH changed AS ('
+        f'    SELECT {columns}, tenure_type AS old_tenure_type, {TENURE_TYPE_SQL} AS new_tenure_type '
+        '    FROM private_residential_property_transactions '
+        f'    WHERE contract_date >= %s AND contract_date < %s AND {condition}'
+        '), deltas AS ('
+        f'    SELECT {columns}, old_tenure_type AS tenure_type, -1 AS sign FROM changed '
+        '    UNION ALL '
+        f'    SELECT {columns}, new_tenure_type AS tenure_type, 1 AS sign FROM changed'
+        '), updated AS ('
+        '    UPDATE private_residential_property_transactions prpt '
+        '    SET tenure_type = c.new_tenure_type '
+        '    FROM changed c '
+        f"    WHERE {' AND '.join(f'prpt.{key} = c.{key}' for key in keys.split(', '))} "
+        '    RETURNING 1'
+        f'), merged AS ({rollup_merge_sql("deltas", sign="sign")}) '
+        'SELECT count(*) FROM updated;'
     )
-    conn = None
+    cleanup_query = 'DELETE FROM transactions_rollup WHERE transactions = 0;'
+    total = 0
     try:
-        conn = pg.connect(**params)
-        cur = conn.cursor()
-
-        for record in transactions:
-            project = record[0]
-            street = record[1]
-            area = record[2]
-            floor_range = record[3]
-            contract_date = record[4]
-            type_of_sale = record[5]
-            price = record[6]
-            tenure = record[7]
-            tenure_type = record[8]
-
-            if tenure_type is None:
-                LOGGER.debug(f'No tenure type found - {record}')
-                tenure_type = get_tenure_type(tenure)
-                values = (tenure_type, project, street, area, floor_range, contract_date, type_of_sale, price)
-                cur.execute(query, values)
-        conn.commit()
+        with cursor() as cur:
+            cur.execute(years_query)
+            first_year, last_year = cur.fetchone()
+        if first_year is None:
+            LOGGER.warning('No transactions found, check private_residential_property_transactions DB table')
+            return total
+        start = time.perf_counter()
+        for year in range(first_year, last_year + 1):
+            with cursor() as cur:
+                cur.execute(query, (datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)))
+                updated = cur.fetchone()[0]
+                if updated:
+                    cur.execute(cleanup_query)
+                    bump_data_generation(cur)
+            total += updated
+            LOGGER.info(
+                f'Tenure type backfill {year - first_year + 1}/{last_year - first_year + 1} years, '
+                f'{year}: {updated} rows, {total} total in {time.perf_counter() - start:.1f}s')
     except (pg.Error) as e:
         LOGGER.exception(e)
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+        metrics.record(errors=1)
+    return total
@@ -1,5 +1,10 @@
+import json
 import math
+import codecs
 import datetime
+import functools
+import numpy as np
+import pandas as pd
 
 
 def format_date(dt_str):
@@ -62,6 +67,42 @@ def get_tenure_type(tenure):
         return tenure_type
 
 
+MEMO_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def cached_contract_date(dt_str):
+    return format_date(dt_str).date()
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def cached_convert_abbreviation(short_string):
+    return convert_abbreviation(short_string)
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def cached_get_tenure_type(tenure):
+    return get_tenure_type(tenure)
+
+
+def map_distinct(values, func):
+    """Applies func once per distinct value, URA dates, streets and tenures
+       repeat across thousands of transactions
+
+    Args:
+        values (array-like): input values, None is passed through without calling func
+        func (callable): scalar function, ideally memoized across batches
+
+    Returns:
+        [np.ndarray]: object array of func results aligned with values
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    mapped = np.empty(len(uniques) + 1, dtype=object)
+    mapped[:-1] = [func(value) for value in uniques]
+    mapped[-1] = None
+    return mapped[codes]
+
+
 def get_coordinates_center(data):
     """Calculate the centre of a list of latitude and logitude coordinates using degrees.
 
@@ -111,3 +152,183 @@ def get_coordinates_distance(coord1, coord2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     dist = R * c
     return dist
+
+
+def compact_frame(df, dtypes):
+    """Casts the columns of df named in dtypes, e.g. low cardinality strings to
+       category and measures to narrower numeric types
+
+    Args:
+        df (pd.DataFrame): frame to convert
+        dtypes (dict): column -> dtype, columns missing from df are ignored
+
+    Returns:
+        [pd.DataFrame]: converted copy of df
+    """
+    return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+
+
+def memory_report(before, after):
+    """Per column memory of a frame before and after compact_frame
+
+    Args:
+        before (pd.DataFrame): original frame
+        after (pd.DataFrame): converted frame
+
+    Returns:
+        [pd.DataFrame]: dtype and deep memory in bytes before and after for
+            every column plus a total row
+    """
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index=False, deep=True),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_after': after.memory_usage(index=False, deep=True),
+    })
+    report.loc['total'] = ['', report['bytes_before'].sum(), '', report['bytes_after'].sum()]
+    report['ratio'] = report['bytes_after'] / report['bytes_before'].where(report['bytes_before'] > 0)
+    return report
+
+
+SVY21_A = 6378137.0
+SVY21_F = 1 / 298.257223563
+SVY21_ORIGIN_LAT = 1.366666
+SVY21_ORIGIN_LONG = 103.833333
+SVY21_FALSE_NORTHING = 38744.572
+SVY21_FALSE_EASTING = 28001.642
+SVY21_SCALE = 1.0
+
+
+def _svy21_meridian_distance(lat_rad):
+    e2 = 2 * SVY21_F - SVY21_F * SVY21_F
+    e4 = e2 * e2
+    e6 = e4 * e2
+    a0 = 1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256
+    a2 = 3 / 8 * (e2 + e4 / 4 + 15 * e6 / 128)
+    a4 = 15 / 256 * (e4 + 3 * e6 / 4)
+    a6 = 35 * e6 / 3072
+    return SVY21_A * (a0 * lat_rad - a2 * np.sin(2 * lat_rad) + a4 * np.sin(4 * lat_rad) - a6 * np.sin(6 * lat_rad))
+
+
+def svy21_to_wgs84(x, y):
+    """Converts SVY21 (EPSG:3414) coordinates to WGS84 latitude and longitude
+       with the inverse Transverse Mercator series, no network calls needed.
+       Replaces the OneMap 3414to4326 conversion for URA project x and y.
+
+    Args:
+        x (float or array-like): SVY21 easting in metres
+        y (float or array-like): SVY21 northing in metres
+
+    Returns:
+        [tuple]: latitude and longitude in degrees, arrays for array input
+    """
+    easting = np.asarray(x, dtype=np.float64)
+    northing = np.asarray(y, dtype=np.float64)
+    a = SVY21_A
+    b = a * (1 - SVY21_F)
+    k = SVY21_SCALE
+    e2 = 2 * SVY21_F - SVY21_F * SVY21_F
+
+    m_prime = _svy21_meridian_distance(np.radians(SVY21_ORIGIN_LAT)) + (northing - SVY21_FALSE_NORTHING) / k
+    n = (a - b) / (a + b)
+    n2 = n * n
+    n3 = n2 * n
+    n4 = n2 * n2
+    g = a * (1 - n) * (1 - n2) * (1 + 9 * n2 / 4 + 225 * n4 / 64) * (np.pi / 180)
+    sigma = m_prime * np.pi / (180 * g)
+    lat_prime = (sigma +
+                 (3 * n / 2 - 27 * n3 / 32) * np.sin(2 * sigma) +
+                 (21 * n2 / 16 - 55 * n4 / 32) * np.sin(4 * sigma) +
+                 (151 * n3 / 96) * np.sin(6 * sigma) +
+                 (1097 * n4 / 512) * np.sin(8 * sigma))
+
+    sin2 = np.sin(lat_prime) ** 2
+    rho = a * (1 - e2) / (1 - e2 * sin2) ** 1.5
+    v = a / np.sqrt(1 - e2 * sin2)
+    psi = v / rho
+    psi2 = psi * psi
+    psi3 = psi2 * psi
+    psi4 = psi2 * psi2
+    sec_lat = 1 / np.cos(lat_prime)
+    t = np.tan(lat_prime)
+    t2 = t * t
+    t4 = t2 * t2
+    t6 = t4 * t2
+    e_prime = easting - SVY21_FALSE_EASTING
+    x1 = e_prime / (k * v)
+    x3 = x1 ** 3
+    x5 = x1 ** 5
+    x7 = x1 ** 7
+
+    lat_factor = t / (k * rho)
+    lat = (lat_prime -
+           lat_factor * (e_prime * x1 / 2) +
+           lat_factor * (e_prime * x3 / 24) * (-4 * psi2 + 9 * psi * (1 - t2) + 12 * t2) -
+           lat_factor * (e_prime * x5 / 720) * (
+               8 * psi4 * (11 - 24 * t2) - 12 * psi3 * (21 - 71 * t2) +
+               15 * psi2 * (15 - 98 * t2 + 15 * t4) + 180 * psi * (5 * t2 - 3 * t4) + 360 * t4) +
+           lat_factor * (e_prime * x7 / 40320) * (1385 - 3633 * t2 + 4095 * t4 + 1575 * t6))
+    long = (np.radians(SVY21_ORIGIN_LONG) +
+            x1 * sec_lat -
+            (x3 * sec_lat / 6) * (psi + 2 * t2) +
+            (x5 * sec_lat / 120) * (-4 * psi3 * (1 - 6 * t2) + psi2 * (9 - 68 * t2) + 72 * psi * t2 + 24 * t4) -
+            (x7 * sec_lat / 5040) * (61 + 662 * t2 + 1320 * t4 + 720 * t6))
+    return np.degrees(lat), np.degrees(long)
+
+
+def iter_json_array(chunks, key):
+    """Incrementally decodes the objects of the array stored under key in a JSON
+       document, yielding one element at a time so the full document is never
+       held in memory.
+
+    Args:
+        chunks (iterable): utf-8 encoded byte chunks of the JSON document
+        key (str): name of the member holding the array, e.g. 'Result'
+
+    Yields:
+        [dict]: array elements in document order
+
+    Raises:
+        json.JSONDecodeError: if the document ends inside the array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    marker = '"%s"' % key
+    buf = ''
+    in_array = False
+    eof = False
+    while True:
+        if not in_array:
+            idx = buf.find(marker)
+            bracket = buf.find('[', idx + len(marker)) if idx >= 0 else -1
+            if bracket >= 0:
+                if buf[idx + len(marker):bracket].strip() != ':':
+                    return
+                buf = buf[bracket + 1:]
+                in_array = True
+                continue
+        else:
+            buf = buf.lstrip(' \t\r\n,')
+            if buf.startswith(']'):
+                return
+            if buf:
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                    buf = buf[end:]
+                    yield obj
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+        if eof:
+            if in_array:
+                # A truncated download must not look like a complete, shorter array
+                raise json.JSONDecodeError(f'Unterminated array under "{key}"', buf, len(buf))
+            return
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf += text_decoder.decode(b'', final=True)
+        else:
+            buf += text_decoder.decode(chunk)
@@ -0,0 +1,63 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import mrt_index  # noqa: E402
+from mrt_index import EARTH_RADIUS, MrtIndex  # noqa: E402
+
+# Relative error of the equirectangular projection against haversine across Singapore
+RTOL = 1e-3
+
+
+def haversine(longitude, latitude, longitudes, latitudes):
+    lon1, lat1, lon2, lat2 = map(np.radians, (longitude, latitude, longitudes, latitudes))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+@pytest.fixture
+def stations():
+    rng = np.random.default_rng(7)
+    longitudes = rng.uniform(103.6, 104.0, 25)
+    latitudes = rng.uniform(1.25, 1.45, 25)
+    return MrtIndex([f'NS{i}' for i in range(25)], [f'STATION {i}' for i in range(25)], longitudes, latitudes)
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(11)
+    return rng.uniform(103.6, 104.0, 50), rng.uniform(1.25, 1.45, 50)
+
+
+@pytest.mark.parametrize('k', [1, 3, 25, 40])
+def test_nearest_matches_brute_force(monkeypatch, stations, points, k):
+    # Chunks of 7 leave a short last chunk and exercise the chunked scan
+    monkeypatch.setattr(mrt_index, 'QUERY_CHUNK_SIZE', 7)
+    longitude, latitude = points
+    idx, dist = stations.nearest(longitude, latitude, k=k)
+    k = min(k, len(stations))
+    assert idx.shape == dist.shape == (len(longitude), k)
+    for i in range(len(longitude)):
+        expected = np.sort(haversine(longitude[i], latitude[i], stations.longitudes, stations.latitudes))[:k]
+        np.testing.assert_allclose(dist[i], expected, rtol=RTOL)
+        np.testing.assert_allclose(
+            haversine(longitude[i], latitude[i], stations.longitudes[idx[i]], stations.latitudes[idx[i]]),
+            dist[i], rtol=RTOL)
+        assert np.all(np.diff(dist[i]) >= 0)
+    if k == len(stations):
+        assert all(sorted(row) == list(range(len(stations))) for row in idx.tolist())
+
+
+def test_nearest_scalar(stations):
+    idx, dist = stations.nearest(103.85, 1.3, k=2)
+    assert idx.shape == dist.shape == (2,)
+    expected = haversine(103.85, 1.3, stations.longitudes, stations.latitudes)
+    assert idx[0] == np.argmin(expected)
+    np.testing.assert_allclose(dist, np.sort(expected)[:2], rtol=RTOL)
+
+
+def test_from_records_empty():
+    assert len(MrtIndex.from_records([])) == 0
@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from utils import iter_json_array, svy21_to_wgs84  # noqa: E402
+
+# SVY21 x, y and the WGS84 latitude, longitude of the EPSG:3414 to EPSG:4326 conversion OneMap's 3414to4326 performs
+SVY21_WGS84_PAIRS = [
+    (28983.788, 33554.5, 1.3197294829, 103.8421584262),
+    (20276.794, 31255.976, 1.2989414989, 103.7639221428),
+    (30000.0, 30000.0, 1.2875837891, 103.8512893919),
+    (11000.0, 36000.0, 1.3418409343, 103.6805635537),
+    (41000.0, 39000.0, 1.3689738038, 103.9501326031),
+    (26000.0, 47500.0, 1.4458475344, 103.8153465893),
+    (8500.0, 27000.0, 1.2604469706, 103.6581052616),
+]
+TOLERANCE_DEG = 1e-6
+
+
+@pytest.mark.parametrize('x, y, latitude, longitude', SVY21_WGS84_PAIRS)
+def test_svy21_to_wgs84_scalar(x, y, latitude, longitude):
+    lat, lon = svy21_to_wgs84(x, y)
+    assert abs(float(lat) - latitude) < TOLERANCE_DEG
+    assert abs(float(lon) - longitude) < TOLERANCE_DEG
+
+
+def test_svy21_to_wgs84_array():
+    x, y, latitude, longitude = (np.array(column) for column in zip(*SVY21_WGS84_PAIRS))
+    lat, lon = svy21_to_wgs84(x, y)
+    assert lat.shape == lon.shape == x.shape
+    np.testing.assert_allclose(lat, latitude, rtol=0, atol=TOLERANCE_DEG)
+    np.testing.assert_allclose(lon, longitude, rtol=0, atol=TOLERANCE_DEG)
+
+
+def chunked(document, size):
+    data = document.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_json_array_yields_elements_across_chunks():
+    result = [{'project': 'THE SAIL @ MARINA BAY', 'transaction': [{'price': '1200000'}]}, {'project': 'ÉCLAT'}]
+    document = json.dumps({'Status': 'Success', 'Result': result})
+    for size in (1, 7, len(document)):
+        assert list(iter_json_array(chunked(document, size), 'Result')) == result
+
+
+def test_iter_json_array_raises_on_truncated_array():
+    document = json.dumps({'Status': 'Success', 'Result': [{'project': 'A'}, {'project': 'B'}]})
+    for end in (document.index('{"project": "B"}'), document.rindex(']')):
+        with pytest.raises(json.JSONDecodeError):
+            list(iter_json_array(chunked(document[:end], 5), 'Result'))